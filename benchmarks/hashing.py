@@ -0,0 +1,84 @@
+'''
+    Compares the adaptive read path in crawler.checksum with the old
+    fixed 8 KiB read loop, per file size class.
+    Usage:
+        python benchmarks/hashing.py [--dir DIR] [--hash md5 --hash sha256]
+
+    Files are read back straight after being written, so the numbers
+    are for a warm page cache: they show the cost of the read loop
+    itself, not of the device.
+'''
+import os
+import sys
+import time
+import hashlib
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import crawler
+
+# (name, size of each file, number of files)
+CLASSES = [('tiny', 4 * 1024, 2000),
+           ('medium', 4 * 1024 * 1024, 32),
+           ('large', 256 * 1024 * 1024, 2)]
+
+
+def legacy_checksum(filename, hashes, blocksize=8192):
+    '''
+        The read loop checksum_md5 used before the adaptive read path.
+    '''
+    hashers = [hashlib.new(name) for name in hashes]
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(blocksize), b''):
+            for hasher in hashers:
+                hasher.update(chunk)
+    return [hasher.hexdigest() for hasher in hashers]
+
+
+def makefiles(directory, size, count):
+    block = os.urandom(min(size, 1024 * 1024))
+    paths = []
+    for num in range(count):
+        path = os.path.join(directory, '%d.bin' % num)
+        with open(path, 'wb') as f:
+            for _ in range(size // len(block)):
+                f.write(block)
+            f.write(block[:size % len(block)])
+        paths.append(path)
+    return paths
+
+
+def timeit(func, paths, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for path in paths:
+            func(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", help="Where to create the test files",
+                        type=str)
+    parser.add_argument("--hash", action="append", dest="hashes")
+    args = parser.parse_args()
+    hashes = args.hashes or ['md5']
+
+    print "%-8s %12s %12s %8s" % ('class', 'old MB/s', 'new MB/s', 'gain')
+    for name, size, count in CLASSES:
+        directory = tempfile.mkdtemp(dir=args.dir)
+        try:
+            paths = makefiles(directory, size, count)
+            megs = size * count / 1e6
+            old = timeit(lambda p: legacy_checksum(p, hashes), paths)
+            new = timeit(lambda p: crawler.checksum(p, hashes, size=size),
+                         paths)
+            print "%-8s %12.1f %12.1f %7.2fx" % (name, megs / old, megs / new,
+                                                old / new)
+        finally:
+            shutil.rmtree(directory)
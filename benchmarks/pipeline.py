@@ -0,0 +1,210 @@
+'''
+    Times each stage of the crawl pipeline on synthetic trees.
+    Usage:
+        python benchmarks/pipeline.py [--shape tiny --shape mixed]
+                                      [--scale 0.1] [--output run.json]
+                                      [--compare old.json]
+
+    For every shape from trees.py a tree is generated and the walk,
+    stat, magic, hash and write stages are timed on their own, followed
+    by a whole write_data crawl. Each stage reports files/s and, where
+    it reads file data, MB/s. Results are saved as JSON; --compare
+    prints the change against an earlier run and exits non-zero if a
+    stage got slower by more than --tolerance.
+
+    As with hashing.py the trees are read back straight after being
+    written, so the page cache is warm: this measures our code, not
+    the disk.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import crawler
+import trees
+
+
+def best(func, repeat):
+    '''
+        Fastest of repeat runs of func, and what the last run returned.
+    '''
+    fastest = result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+    return fastest, result
+
+
+def walk(top):
+    return list(crawler.getfilepaths(top))
+
+
+def stat(paths):
+    return [os.stat(path) for path in paths]
+
+
+def sniff(paths, sniffsize):
+    heads = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            heads.append((path, f.read(sniffsize)))
+    return heads
+
+
+def types(heads):
+    # start cold, or every run after the first only measures the cache
+    crawler._TYPECACHE.clear()
+    return [crawler.getfiletype(path, head, len(head))
+            for path, head in heads]
+
+
+def hashes(paths, sizes, algorithms):
+    return [crawler.hashfile(path, algorithms, size=size)[0]
+            for path, size in zip(paths, sizes)]
+
+
+def write(fmt, records, fields, directory):
+    fname = os.path.join(directory, 'out.' + fmt)
+    writer = crawler.WRITERS[fmt](fname, directory, fields)
+    for record in records:
+        writer.writerow(record)
+    writer.close()
+    os.remove(fname)
+
+
+def crawl(top, fmt, directory, **options):
+    fname = os.path.join(directory, 'crawl.' + fmt)
+    written = crawler.write_data(fname, top, fmt=fmt, **options)
+    os.remove(fname)
+    return written
+
+
+def rates(seconds, files, nbytes=None):
+    result = {'seconds': round(seconds, 4),
+              'files_per_s': round(files / seconds, 1) if seconds else None}
+    if nbytes is not None:
+        result['mb_per_s'] = round(nbytes / 1e6 / seconds, 1) \
+            if seconds else None
+    return result
+
+
+def bench(shape, scale, seed, repeat, algorithms, formats, workers, base):
+    top = os.path.join(base, shape)
+    files, total = trees.maketree(top, shape, scale, seed)
+    results = {'files': files, 'bytes': total, 'stages': {}}
+    stages = results['stages']
+
+    seconds, paths = best(lambda: walk(top), repeat)
+    stages['walk'] = rates(seconds, len(paths))
+    seconds, stats = best(lambda: stat(paths), repeat)
+    stages['stat'] = rates(seconds, len(paths))
+    sizes = [st.st_size for st in stats]
+
+    heads = sniff(paths, crawler.SNIFFSIZE)
+    seconds, filetypes = best(lambda: types(heads), repeat)
+    stages['magic'] = rates(seconds, len(paths),
+                            sum(len(head) for path, head in heads))
+
+    seconds, digests = best(lambda: hashes(paths, sizes, algorithms), repeat)
+    stages['hash'] = rates(seconds, len(paths), sum(sizes))
+
+    records = [crawler.getmetadata(path, st, (filetype, digest), algorithms)
+               for path, st, filetype, digest
+               in zip(paths, stats, filetypes, digests)]
+    fields = crawler.getfields(algorithms)
+    for fmt in formats:
+        seconds, _ = best(lambda: write(fmt, records, fields, base), repeat)
+        stages['write_' + fmt] = rates(seconds, len(records))
+
+    seconds, _ = best(lambda: crawl(top, formats[0], base,
+                                    hashes=algorithms, workers=workers),
+                      repeat)
+    stages['crawl'] = rates(seconds, files, total)
+    shutil.rmtree(top)
+    return results
+
+
+def compare(old, new, tolerance):
+    '''
+        Prints per-stage speed changes from old to new; returns the
+        stages that slowed down by more than tolerance.
+    '''
+    slower = []
+    print "%-8s %-14s %12s %12s %8s" % ('shape', 'stage', 'before',
+                                        'after', 'change')
+    for shape, result in sorted(new['shapes'].items()):
+        before = old['shapes'].get(shape, {}).get('stages', {})
+        for stage, numbers in sorted(result['stages'].items()):
+            if stage not in before:
+                continue
+            was, now = before[stage]['seconds'], numbers['seconds']
+            change = was / now if now else float('inf')
+            print "%-8s %-14s %11.3fs %11.3fs %7.2fx" % (shape, stage, was,
+                                                         now, change)
+            if change < 1 - tolerance:
+                slower.append((shape, stage))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", action="append", dest="shapes",
+                        choices=sorted(trees.SHAPES))
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--hash", action="append", dest="hashes")
+    parser.add_argument("--format", action="append", dest="formats",
+                        choices=sorted(crawler.SUFFIXES))
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Pool size for the whole-crawl stage")
+    parser.add_argument("--dir", help="Where to create the trees")
+    parser.add_argument("--output", help="Save results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Slowdown that counts as a regression")
+    args = parser.parse_args()
+    shapes = args.shapes or sorted(trees.SHAPES)
+    algorithms = args.hashes or ['md5']
+    formats = args.formats or ['csv', 'columnar']
+
+    run = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(),
+           'platform': platform.platform(),
+           'options': {'scale': args.scale, 'seed': args.seed,
+                       'repeat': args.repeat, 'hashes': algorithms,
+                       'workers': args.workers},
+           'shapes': {}}
+    base = tempfile.mkdtemp(dir=args.dir)
+    try:
+        print "%-8s %-14s %10s %12s %10s" % ('shape', 'stage', 'seconds',
+                                             'files/s', 'MB/s')
+        for shape in shapes:
+            result = bench(shape, args.scale, args.seed, args.repeat,
+                           algorithms, formats, args.workers, base)
+            run['shapes'][shape] = result
+            for stage, numbers in sorted(result['stages'].items()):
+                print "%-8s %-14s %10.3f %12s %10s" % (
+                    shape, stage, numbers['seconds'], numbers['files_per_s'],
+                    numbers.get('mb_per_s', ''))
+    finally:
+        shutil.rmtree(base)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(json.load(f), run, args.tolerance)
+        if slower:
+            print "Slower than before: %s" % ", ".join(
+                "%s/%s" % pair for pair in slower)
+            sys.exit(1)
@@ -0,0 +1,75 @@
+'''
+    Compares hashing a tree in walk order with crawler.readorder's
+    inode and extent orders.
+    Usage:
+        python benchmarks/readorder.py [--shape fragmented] [--dir DIR]
+
+    Unlike the other benchmarks this one is about the device, so the
+    page cache is dropped before every pass; that needs root (it writes
+    /proc/sys/vm/drop_caches), and without it the numbers are only for a
+    warm cache. Use --dir to put the tree on the disk under test: the
+    gains show on spinning disks and cheap USB flash, far less on SSDs
+    and virtual disks.
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import crawler
+import trees
+
+
+def dropcaches():
+    os.system('sync')
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except IOError:
+        return False
+
+
+def readall(tasks):
+    total = 0
+    for path, st, known in tasks:
+        crawler.hashfile(path, ('md5',), size=st.st_size)
+        total += st.st_size
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", choices=sorted(trees.SHAPES),
+                        default="fragmented")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--window", type=int, default=10000)
+    parser.add_argument("--dir", help="Where to create the tree")
+    args = parser.parse_args()
+
+    base = tempfile.mkdtemp(dir=args.dir)
+    try:
+        top = os.path.join(base, args.shape)
+        trees.maketree(top, args.shape, args.scale, args.seed)
+        tasks = [(path, st, None) for path, st in crawler.gettasks(top)]
+        cold = True
+        print "%-8s %10s %10s" % ('order', 'seconds', 'MB/s')
+        for order in ['walk', 'inode', 'extent']:
+            cold = dropcaches() and cold
+            start = time.time()
+            if order == 'walk':
+                total = readall(tasks)
+            else:
+                total = readall(crawler.readorder(iter(tasks), args.window,
+                                                  order))
+            elapsed = time.time() - start
+            print "%-8s %10.2f %10.1f" % (order, elapsed,
+                                          total / 1e6 / elapsed)
+        if not cold:
+            print "Could not drop the page cache (not root?): warm numbers"
+    finally:
+        shutil.rmtree(base)
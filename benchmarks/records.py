@@ -0,0 +1,106 @@
+'''
+    Compares the slotted crawler.Record with the OrderedDict per file
+    and csv.DictWriter the crawler used before: memory per record and
+    rows/s through the CSV writer.
+    Usage:
+        python benchmarks/records.py [--rows 200000]
+
+    Memory is the growth in peak RSS while holding --rows records (as a
+    writer queue would), measured in a fresh child process per variant.
+'''
+import os
+import sys
+import csv
+import time
+import resource
+import argparse
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import crawler
+
+STAT = os.stat(__file__)
+
+
+def legacy_record(num):
+    '''
+        What getmetadata built per file before Record.
+    '''
+    metadata = OrderedDict()
+    metadata['path'] = '/media/disk/dir%d/file%d.jpg' % (num // 100, num)
+    metadata['filesize'] = STAT.st_size + num
+    for timestamp in crawler.TIMES:
+        metadata[timestamp] = crawler._time_ns(STAT, timestamp)
+    metadata['filetype'] = 'image/jpeg'
+    metadata['digest'] = '%032x' % num
+    return metadata
+
+
+def record(num):
+    return crawler.Record('/media/disk/dir%d/file%d.jpg' % (num // 100, num),
+                          STAT.st_size + num,
+                          crawler._time_ns(STAT, 'atime'),
+                          crawler._time_ns(STAT, 'mtime'),
+                          crawler._time_ns(STAT, 'ctime'),
+                          'image/jpeg', '%032x' % num)
+
+
+def legacy_write(fname, records):
+    with open(fname, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=crawler.KEYS)
+        writer.writeheader()
+        for row in records:
+            writer.writerow(row)
+
+
+def write(fname, records):
+    writer = crawler.CSVWriter(fname, timeformat=crawler.TimeFormatter('ns'))
+    for row in records:
+        writer.writerow(row)
+    writer.close()
+
+
+def _held(make, rows, results):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    records = [make(num) for num in range(rows)]
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    results.put((after - before) * 1024.0 / len(records))
+
+
+def memory(make, rows):
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_held, args=(make, rows, results))
+    child.start()
+    perrecord = results.get()
+    child.join()
+    return perrecord
+
+
+def speed(make, writer, rows, directory):
+    fname = os.path.join(directory, 'out.csv')
+    start = time.time()
+    writer(fname, (make(num) for num in range(rows)))
+    elapsed = time.time() - start
+    os.remove(fname)
+    return rows / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dir", help="Where to write the CSV files")
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        print "%-12s %14s %12s" % ('record', 'bytes/record', 'rows/s')
+        for name, make, writer in [('OrderedDict', legacy_record,
+                                    legacy_write),
+                                   ('Record', record, write)]:
+            print "%-12s %14.0f %12.0f" % (
+                name, memory(make, args.rows),
+                speed(make, writer, args.rows, directory))
+    finally:
+        os.rmdir(directory)
@@ -0,0 +1,173 @@
+'''
+    Reproducible synthetic directory trees for the benchmarks.
+    Usage:
+        python benchmarks/trees.py DIR [--shape mixed] [--scale 0.1]
+
+    Every shape is generated from a seeded random.Random, so the same
+    shape, scale and seed always give the same names, sizes and bytes.
+    scale multiplies the number of files (and for "huge" their size),
+    so quick runs and full runs exercise the same layout.
+'''
+import os
+import random
+import argparse
+
+# leading bytes that libmagic recognises, used by the mixed shape
+SIGNATURES = [('.png', b'\x89PNG\r\n\x1a\n\0\0\0\rIHDR'),
+              ('.pdf', b'%PDF-1.4\n'),
+              ('.zip', b'PK\x03\x04\x14\0\0\0\x08\0'),
+              ('.gif', b'GIF89a'),
+              ('.jpg', b'\xff\xd8\xff\xe0\0\x10JFIF\0'),
+              ('.txt', b''),
+              ('.bin', b'')]
+BLOCK = 64 * 1024
+
+
+class Filler:
+    '''
+        Deterministic file contents: a seeded block of random bytes,
+        made unique per file by a counter at its start.
+    '''
+
+    def __init__(self, rng):
+        self.block = bytearray(rng.getrandbits(8) for _ in range(BLOCK))
+        self.count = 0
+
+    def write(self, path, size, head=b'', text=False):
+        self.count += 1
+        with open(path, 'wb') as f:
+            if text:
+                line = ('line %d of a text file\n' % self.count).encode()
+                data = line * (size // len(line) + 1)
+                f.write(data[:size])
+                return size
+            first = (head + str(self.count).encode() + b'\0')[:size]
+            f.write(first)
+            left = size - len(first)
+            while left > 0:
+                piece = self.block[:min(left, BLOCK)]
+                f.write(piece)
+                left -= len(piece)
+        return size
+
+
+def _count(number, scale):
+    return max(1, int(number * scale))
+
+
+def tiny(top, rng, scale):
+    # many small files in a few hundred directories
+    filler = Filler(rng)
+    files = total = 0
+    for num in range(_count(20000, scale)):
+        directory = os.path.join(top, 'd%03d' % (num % 200))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        total += filler.write(os.path.join(directory, 'f%d' % num),
+                              rng.randint(0, 4096))
+        files += 1
+    return files, total
+
+
+def huge(top, rng, scale):
+    # a few large files
+    filler = Filler(rng)
+    os.makedirs(top)
+    size = _count(256 * 1024 * 1024, scale)
+    for num in range(4):
+        filler.write(os.path.join(top, 'big%d.bin' % num), size)
+    return 4, 4 * size
+
+
+def deep(top, rng, scale):
+    # long chains of nested directories with a few files at each level
+    filler = Filler(rng)
+    files = total = 0
+    for chain in range(_count(50, scale)):
+        directory = os.path.join(top, 'c%d' % chain)
+        for level in range(40):
+            directory = os.path.join(directory, 'l%d' % level)
+            os.makedirs(directory)
+            for num in range(3):
+                total += filler.write(os.path.join(directory, 'f%d' % num),
+                                      rng.randint(0, 16384))
+                files += 1
+    return files, total
+
+
+def wide(top, rng, scale):
+    # one flat directory holding a great many files
+    filler = Filler(rng)
+    os.makedirs(top)
+    files = _count(30000, scale)
+    total = 0
+    for num in range(files):
+        total += filler.write(os.path.join(top, 'file%06d.dat' % num),
+                              rng.randint(0, 2048))
+    return files, total
+
+
+def mixed(top, rng, scale):
+    # a realistic spread of types and sizes, mostly small, a few large
+    filler = Filler(rng)
+    files = total = 0
+    for num in range(_count(5000, scale)):
+        directory = os.path.join(top, 'p%d' % (num % 37),
+                                 'q%d' % (num % 11))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        ext, head = rng.choice(SIGNATURES)
+        size = int(min(rng.lognormvariate(9, 2.5), 64 * 1024 * 1024))
+        total += filler.write(os.path.join(directory, 'f%d%s' % (num, ext)),
+                              size, head, text=(ext == '.txt'))
+        files += 1
+    return files, total
+
+
+def fragmented(top, rng, scale):
+    # files grown a block at a time in turn, with an fsync after each
+    # round so the filesystem interleaves their extents on disk
+    filler = Filler(rng)
+    files = _count(200, scale)
+    names = ['%s/d%d/f%d' % (top, num % 20, num) for num in range(files)]
+    sizes = [rng.randint(1, 32) * BLOCK for _ in names]
+    rng.shuffle(names)
+    for name in names:
+        if not os.path.isdir(os.path.dirname(name)):
+            os.makedirs(os.path.dirname(name))
+    handles = [open(name, 'wb') for name in names]
+    try:
+        for piece in range(max(sizes) // BLOCK):
+            for handle, size in zip(handles, sizes):
+                if piece * BLOCK < size:
+                    handle.write(filler.block)
+            for handle in handles:
+                handle.flush()
+                os.fsync(handle.fileno())
+    finally:
+        for handle in handles:
+            handle.close()
+    return files, sum(sizes)
+
+
+SHAPES = {'tiny': tiny, 'huge': huge, 'deep': deep, 'wide': wide,
+          'mixed': mixed, 'fragmented': fragmented}
+
+
+def maketree(top, shape, scale=1.0, seed=0):
+    '''
+        Builds shape under top, which must not exist yet. Returns the
+        number of files and bytes written.
+    '''
+    return SHAPES[shape](top, random.Random(seed), scale)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dir", help="Directory to create")
+    parser.add_argument("--shape", choices=sorted(SHAPES), default="mixed")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    files, total = maketree(args.dir, args.shape, args.scale, args.seed)
+    print "%d files, %.1f MB in %s" % (files, total / 1e6, args.dir)
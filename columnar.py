@@ -0,0 +1,264 @@
+'''
+    Compact column-oriented file format for crawl results.
+    Usage:
+        from columnar import ColumnarFile
+        crawl = ColumnarFile('crawl.fcol')
+        sizes = crawl.column('filesize')     # array of int64 values
+        for record in crawl.records(['path', 'digest']):
+            ...
+
+    A file is a header, a run of row groups and a JSON footer. Within a
+    row group every column is stored on its own, so a reader only
+    touches the columns it asks for:
+        int   little-endian int64 (sizes)
+        ns    the same, for timestamps in nanoseconds since the epoch
+        str   uint32 end offsets followed by the UTF-8 bytes
+        dict  a str block of distinct values plus an int32 code per row
+        bin   fixed-width raw bytes (digests), all zeros when missing
+    Missing integers are stored as INTNULL.
+    The footer lists each group's row count and where its columns are,
+    then comes its length as uint64 and the magic again.
+'''
+import sys
+import json
+import array
+import struct
+import binascii
+from collections import OrderedDict
+try:
+    from itertools import izip as zip
+except ImportError:
+    pass  # Python 3 zip is already lazy
+
+MAGIC = b'FILERCOL'
+VERSION = 2
+# how crawl fields are stored; anything else is a str column
+TYPES = {'filesize': 'int', 'ctime': 'ns', 'mtime': 'ns', 'atime': 'ns',
+         'filetype': 'dict', 'match': 'dict', 'hashset': 'dict',
+         'digest': 'bin', 'sample': 'bin'}
+INTNULL = -(1 << 63)
+# Python 2 arrays have no 'q'; 'l' is 64 bits on LP64 platforms, and
+# elsewhere int columns go through struct instead
+try:
+    INT64 = array.array('q').typecode
+except ValueError:
+    INT64 = 'l' if array.array('l').itemsize == 8 else None
+
+
+def _tobytes(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes() if hasattr(values, 'tobytes') \
+        else values.tostring()
+
+
+def _frombytes(typecode, data):
+    values = array.array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _uint32():
+    # 'I' is 32 bits wide on every platform we run on, but check
+    return 'I' if array.array('I').itemsize == 4 else 'L'
+
+
+def _encode(value):
+    if value is None:
+        return b''
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, type(u'')):
+        value = str(value)
+    if sys.version_info[0] < 3:
+        return value.encode('utf-8')
+    return value.encode('utf-8', 'surrogateescape')
+
+
+def _decode(data):
+    if sys.version_info[0] < 3:
+        return data
+    return data.decode('utf-8', 'surrogateescape')
+
+
+def encode_int(values):
+    values = [INTNULL if v is None or v == '' else int(v) for v in values]
+    if INT64 is None:
+        return struct.pack('<%dq' % len(values), *values)
+    return _tobytes(array.array(INT64, values))
+
+
+def encode_str(values):
+    data = [_encode(v) for v in values]
+    ends = array.array(_uint32())
+    end = 0
+    for item in data:
+        end += len(item)
+        ends.append(end)
+    return _tobytes(ends) + b''.join(data)
+
+
+def encode_dict(values):
+    codes = array.array('i')
+    distinct = {}
+    for value in values:
+        if value is None:
+            codes.append(-1)
+        else:
+            codes.append(distinct.setdefault(value, len(distinct)))
+    ordered = sorted(distinct, key=distinct.get)
+    block = encode_str(ordered)
+    return (struct.pack('<II', len(ordered), len(block)) + block +
+            _tobytes(codes))
+
+
+def encode_bin(values):
+    data = [binascii.unhexlify(v) if v else b'' for v in values]
+    width = max([len(item) for item in data] or [0])
+    blank = b'\0' * width
+    return struct.pack('<B', width) + b''.join(item or blank
+                                               for item in data)
+
+
+def decode_int(data, rows):
+    if INT64 is None:
+        return list(struct.unpack('<%dq' % rows, data))
+    return _frombytes(INT64, data)
+
+
+def decode_str(data, rows):
+    size = array.array(_uint32()).itemsize * rows
+    ends = _frombytes(_uint32(), data[:size])
+    blob = data[size:]
+    values, start = [], 0
+    for end in ends:
+        values.append(_decode(blob[start:end]))
+        start = end
+    return values
+
+
+def decode_dict(data, rows):
+    count, length = struct.unpack('<II', data[:8])
+    distinct = decode_str(data[8:8 + length], count)
+    return [distinct[code] if code >= 0 else None
+            for code in _frombytes('i', data[8 + length:])]
+
+
+def decode_bin(data, rows):
+    width = struct.unpack('<B', data[:1])[0]
+    if not width:
+        # every value of the group was empty
+        return [''] * rows
+    blank = b'\0' * width
+    values = []
+    for start in range(1, 1 + width * rows, width):
+        item = data[start:start + width]
+        values.append(binascii.hexlify(item).decode('ascii')
+                      if item != blank else '')
+    return values
+
+
+ENCODERS = {'int': encode_int, 'ns': encode_int, 'str': encode_str,
+            'dict': encode_dict, 'bin': encode_bin}
+DECODERS = {'int': decode_int, 'ns': decode_int, 'str': decode_str,
+            'dict': decode_dict, 'bin': decode_bin}
+
+
+class Writer:
+    '''
+        Writes row groups to fname. rows are sequences of values in the
+        order of fields and types gives each field's column type, see
+        TYPES. position() returns a point that resume can later truncate
+        back to.
+    '''
+
+    def __init__(self, fname, fields, types=None, source=None,
+                 resume=None):
+        self.fields = list(fields)
+        self.types = list(types or [TYPES.get(f, 'str') for f in fields])
+        self.source = source
+        if resume is not None:
+            offset, self.groups = resume
+            self.f = open(fname, 'r+b')
+            self.f.truncate(offset)
+            self.f.seek(offset)
+        else:
+            self.groups = []
+            self.f = open(fname, 'wb')
+            self.f.write(MAGIC + struct.pack('<I', VERSION))
+
+    def writegroup(self, rows):
+        if not rows:
+            return
+        columns = []
+        for kind, values in zip(self.types, zip(*rows)):
+            data = ENCODERS[kind](values)
+            columns.append([self.f.tell(), len(data)])
+            self.f.write(data)
+        self.groups.append([len(rows), columns])
+
+    def position(self):
+        self.f.flush()
+        return [self.f.tell(), [list(group) for group in self.groups]]
+
+    def close(self):
+        footer = json.dumps({
+            'version': VERSION, 'source': self.source,
+            'fields': self.fields, 'types': self.types,
+            'rows': sum(rows for rows, columns in self.groups),
+            'groups': self.groups}).encode('utf-8')
+        self.f.write(footer + struct.pack('<Q', len(footer)) + MAGIC)
+        self.f.close()
+
+
+class ColumnarFile:
+    '''
+        Reads a file made by Writer. Only the footer is read up front;
+        column() loads one column across all row groups.
+    '''
+
+    def __init__(self, fname):
+        self.f = open(fname, 'rb')
+        self.f.seek(-(8 + len(MAGIC)), 2)
+        tail = self.f.read()
+        if tail[8:] != MAGIC:
+            raise ValueError("%s is not a finished columnar file" % fname)
+        length = struct.unpack('<Q', tail[:8])[0]
+        self.f.seek(-(8 + len(MAGIC) + length), 2)
+        footer = json.loads(self.f.read(length).decode('utf-8'))
+        self.source = footer['source']
+        self.fields = footer['fields']
+        self.types = dict(zip(self.fields, footer['types']))
+        self.rows = footer['rows']
+        self.groups = footer['groups']
+
+    def column(self, name):
+        index = self.fields.index(name)
+        decode = DECODERS[self.types[name]]
+        if self.types[name] in ('int', 'ns') and INT64 is not None:
+            values = array.array(INT64)
+        else:
+            values = []
+        for rows, columns in self.groups:
+            offset, length = columns[index]
+            self.f.seek(offset)
+            values.extend(decode(self.f.read(length), rows))
+        return values
+
+    def read(self, columns=None):
+        return OrderedDict((name, self.column(name))
+                           for name in columns or self.fields)
+
+    def records(self, columns=None):
+        data = self.read(columns)
+        names = list(data.keys())
+        for values in zip(*data.values()):
+            yield dict(zip(names, values))
+
+    def close(self):
+        self.f.close()
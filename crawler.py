@@ -9,89 +9,2442 @@ import sys
 import os
 import time
 import hashlib
+import calendar
+import mmap
 import csv
 import logging
 import platform
+import re
+import select
+import stat
+import array
+import sqlite3
+import struct
+import json
+import bisect
+import binascii
+import heapq
 import argparse
-from subprocess import check_output, CalledProcessError
+import mimetypes
+import functools
+import operator
+import threading
+import signal
+import pickle
+import tempfile
+import multiprocessing
+import cProfile
+import pstats
+from multiprocessing.pool import ThreadPool
+from fnmatch import fnmatch
+from subprocess import call, check_output, CalledProcessError
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
 from collections import OrderedDict
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
+
 import magic  # python-magic
+import search
+import columnar
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir  # Python 2 backport
 import usb1
 import libusb1
 
-md5 = hashlib.md5()
 KEYS = ['path', 'ctime', 'filetype', 'filesize', 'mtime', 'atime', 'digest']
-CACHE = {}
+# timestamp fields; records hold them as integer nanoseconds since the
+# epoch and writers format them, see TimeFormatter
+TIMES = ['atime', 'mtime', 'ctime']
+# digest holds the first of these; any others get a column of their own
+HASHES = ['md5', 'sha1', 'sha256', 'sha512', 'blake2b']
+# hashing reads: files up to SMALLFILE bytes are read in one go, from
+# MMAPFILE up they are memory-mapped, and in between BLOCKSIZE pieces
+# are read into a reused buffer
+BLOCKSIZE = 1024 * 1024
+SMALLFILE = 64 * 1024
+MMAPFILE = 64 * 1024 * 1024
+_buffers = threading.local()
+# file types are sniffed from the first SNIFFSIZE bytes of each file
+# with one magic.Magic handle per thread; results are memoised per
+# (size, hash of those bytes), up to TYPECACHESIZE entries
+SNIFFSIZE = 64 * 1024
+# duplicate search: bytes read from each end of equal-sized files
+EDGESIZE = 4 * 1024
+# triage crawls fingerprint a file from SAMPLEBLOCK bytes at its head,
+# at each of SAMPLEPOINTS through it and at its tail; files up to
+# SAMPLEFULL bytes cost no more to hash in full, so they are. The full
+# pass for the rest runs at DEFERREDNICE
+SAMPLEBLOCK = 64 * 1024
+SAMPLEPOINTS = (0.25, 0.5, 0.75)
+SAMPLEFULL = SAMPLEBLOCK * (len(SAMPLEPOINTS) + 2)
+DEFERREDNICE = 10
+TYPECACHESIZE = 100000
+_magic = threading.local()
+_TYPECACHE = {}
+
+
+class Record(object):
+    '''
+        One file's row. Attributes are the crawl fields (KEYS, a column
+        per extra digest algorithm, match, hashset and the triage
+        sample) held in slots,
+        which takes a fraction of the memory of a dict per file and
+        lets writers pull a row out in field order with one
+        operator.attrgetter call, see rowgetter. The item access of
+        the dicts used before still works.
+    '''
+    __slots__ = KEYS + HASHES + ['match', 'hashset', 'sample']
+    _OPTIONAL = HASHES + ['match', 'hashset', 'sample']
+
+    def __init__(self, path=None, filesize=None, atime=None, mtime=None,
+                 ctime=None, filetype=None, digest=None):
+        self.path = path
+        self.filesize = filesize
+        self.atime = atime
+        self.mtime = mtime
+        self.ctime = ctime
+        self.filetype = filetype
+        self.digest = digest
+        for name in self._OPTIONAL:
+            setattr(self, name, None)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def values(self):
+        return _ALLFIELDS(self)
+
+    # slotted objects need explicit state to cross a process pool
+    def __getstate__(self):
+        return _ALLFIELDS(self)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return 'Record(%s)' % ', '.join(
+            '%s=%r' % (name, value)
+            for name, value in zip(self.__slots__, _ALLFIELDS(self))
+            if value is not None)
+
+
+_ALLFIELDS = operator.attrgetter(*Record.__slots__)
+
+
+def rowgetter(fields):
+    '''
+        Function turning a Record into a tuple of fields, in order.
+    '''
+    if len(fields) == 1:
+        getter = operator.attrgetter(fields[0])
+        return lambda record: (getter(record),)
+    return operator.attrgetter(*fields)
+
+
+# write_data options chosen on the command line, shared with USB mode
+CRAWLOPTS = {}
+DBFILE = None
+# search index that finished crawls are added to, see search.py
+INDEXFILE = None
+
+
+class FlushPolicy:
+    '''
+        Tells a buffering writer when to flush: once rows rows or about
+        nbytes bytes are pending, or interval seconds have passed since
+        the last flush, whichever comes first.
+    '''
+
+    def __init__(self, rows=1000, nbytes=1 << 20, interval=5.0):
+        self.rows, self.nbytes, self.interval = rows, nbytes, interval
+        self.reset()
+
+    def reset(self):
+        self.pending = 0
+        self.size = 0
+        self.last = time.time()
+
+    def add(self, row):
+        '''
+            Accounts for one buffered row, a tuple of values; True if a
+            flush is now due.
+        '''
+        self.pending += 1
+        # rough size, numbers count as 8 bytes
+        self.size += sum(len(v) if hasattr(v, '__len__') else 8
+                         for v in row)
+        return (self.pending >= self.rows or self.size >= self.nbytes or
+                time.time() - self.last >= self.interval)
+
+
+class TimeFormatter:
+    '''
+        Turns the nanosecond timestamps in records into text at output
+        time. style is 'iso' (ISO 8601 with nanoseconds and the UTC
+        offset), 'asctime' (whole seconds, as older crawls wrote),
+        'epoch' (seconds with nine decimals) or 'ns' (the raw integer).
+        tz is 'local', 'utc' or a fixed offset such as +05:30. The text
+        of each whole second is cached, since files written together
+        tend to share timestamps.
+    '''
+    STYLES = ['iso', 'asctime', 'epoch', 'ns']
+
+    def __init__(self, style='iso', tz='local', cachesize=100000):
+        if style not in self.STYLES:
+            raise ValueError("unknown time format %s" % style)
+        self.style = style
+        self.offset = self.parsetz(tz)
+        self.cachesize = cachesize
+        self.seconds = {}
+
+    @staticmethod
+    def parsetz(tz):
+        '''
+            None for local time, else the offset from UTC in seconds.
+        '''
+        if tz == 'local':
+            return None
+        if tz.lower() in ('utc', 'z'):
+            return 0
+        match = re.match(r'^([+-])(\d\d):?(\d\d)$', tz)
+        if not match:
+            raise ValueError("bad timezone %s, use local, utc or +HH:MM" %
+                             tz)
+        sign, hours, minutes = match.groups()
+        offset = int(hours) * 3600 + int(minutes) * 60
+        return -offset if sign == '-' else offset
+
+    def _second(self, sec):
+        if self.offset is None:
+            tm = time.localtime(sec)
+            offset = calendar.timegm(tm) - sec
+        else:
+            offset = self.offset
+            tm = time.gmtime(sec + offset)
+        if self.style == 'asctime':
+            text = time.asctime(tm)
+        else:
+            text = (time.strftime('%Y-%m-%dT%H:%M:%S', tm),
+                    '%s%02d:%02d' % ('-' if offset < 0 else '+',
+                                     abs(offset) // 3600,
+                                     abs(offset) % 3600 // 60))
+        if len(self.seconds) >= self.cachesize:
+            self.seconds.clear()
+        self.seconds[sec] = text
+        return text
+
+    def format(self, ns):
+        if ns is None or ns == '':
+            return ''
+        if self.style == 'ns':
+            return str(ns)
+        sec, frac = divmod(int(ns), 1000000000)
+        if self.style == 'epoch':
+            return '%d.%09d' % (sec, frac)
+        text = self.seconds.get(sec) or self._second(sec)
+        if self.style == 'asctime':
+            return text
+        return '%s.%09d%s' % (text[0], frac, text[1])
+
+    def table(self, rows, columns):
+        '''
+            Formats the timestamps in the given column numbers of a
+            batch of rows (lists), in place.
+        '''
+        fmt = self.format
+        for column in columns:
+            for row in rows:
+                row[column] = fmt(row[column])
+        return rows
 
 
 class CSVWriter:
     # source:
     # http://python-forensics.org/2014/06/python-forensics-sqlite-invesigations-part-one/
 
-    def __init__(self, csvfile):
+    def __init__(self, csvfile, source=None, fields=None, flushrows=1000,
+                 flushbytes=1 << 20, flushinterval=5.0, resume=None,
+                 timeformat=None):
+        fields = fields or KEYS
+        self.rows = []
+        self.getter = rowgetter(fields)
+        self.timeformat = timeformat or TimeFormatter()
+        self.times = [num for num, key in enumerate(fields) if key in TIMES]
+        self.errors = 0
+        self.policy = FlushPolicy(flushrows, flushbytes, flushinterval)
         try:
+            if resume is not None:
+                # drop anything written after the checkpoint at resume
+                self.csvfile = open(csvfile, 'r+')
+                self.csvfile.truncate(resume)
+                self.csvfile.seek(resume)
+            else:
+                self.csvfile = open(csvfile, 'w')
             # create a writer object and then write the header row
-            self.csvfile = open(csvfile, 'w')
-            self.writer = csv.DictWriter(self.csvfile, fieldnames=KEYS)
-            self.writer.writeheader()
-        except csv.Error as error:
+            self.writer = csv.writer(self.csvfile)
+            if resume is None:
+                self.writer.writerow(fields)
+        except (csv.Error, IOError) as error:
             logging.info("CSV File: Initialization Failed")
             logging.info(error)
             sys.exit(1)
 
     def writerow(self, row):
+        # rows are buffered and written out according to the flush policy
+        row = self.getter(row)
+        self.rows.append(row)
+        if self.policy.add(row):
+            self.flush()
+
+    def flush(self):
+        # timestamps are formatted a batch at a time, just before writing
+        if self.times:
+            self.rows = self.timeformat.table([list(row) for row in
+                                               self.rows], self.times)
+        try:
+            self._writerows(self.rows)
+        except IOError as error:
+            self.errors += len(self.rows)
+            logging.info("CSV File Write: Failed for %d rows" %
+                         len(self.rows))
+            logging.info(error)
         try:
-            self.writer.writerow(row)
             self.csvfile.flush()
-        except csv.Error as error:
-            logging.info("CSV File Write: Failed")
+        except IOError as error:
+            self.errors += 1
+            logging.info("CSV File Flush: Failed")
             logging.info(error)
-            sys.exit(1)
+        self.rows = []
+        self.policy.reset()
+
+    def _writerows(self, rows):
+        # a bad row is logged and skipped, and writing resumes after it:
+        # rows before it are already out and must not be written twice
+        start = 0
+        while start < len(rows):
+            done = [start]
+
+            def counted(first=start):
+                for row in rows[first:]:
+                    yield row
+                    done[0] += 1
+            try:
+                self.writer.writerows(counted())
+                return
+            except csv.Error as error:
+                self.errors += 1
+                logging.info("CSV File Write: Failed for %s" %
+                             rows[done[0]][0])
+                logging.info(error)
+                start = done[0] + 1
+
+    def position(self):
+        '''
+            Flushes and returns where a resumed crawl picks up.
+        '''
+        self.flush()
+        return self.csvfile.tell()
 
     def close(self):
-        # Close the CSV File
+        # Flush what is left and close the CSV File
+        self.flush()
         try:
             self.csvfile.close()
         except:
             logging.info("Failed to close CSV File Object")
             sys.exit(1)
 
+    @staticmethod
+    def upgrade(csvfile, crawl, results):
+        '''
+            Fills results, (path, {field: value}) pairs from the full
+            pass of a triage crawl, into the rows for those paths. The
+            file is rewritten alongside and renamed over the original,
+            so readers see either version whole. Returns the rows
+            upgraded.
+        '''
+        found = dict(results)
+        if not found:
+            return 0
+        part = csvfile + '.part'
+        with open(csvfile) as old:
+            with open(part, 'w') as new:
+                reader = csv.reader(old)
+                writer = csv.writer(new)
+                header = next(reader)
+                writer.writerow(header)
+                columns = dict((name, num) for num, name in enumerate(header))
+                path = columns['path']
+                for row in reader:
+                    values = found.get(row[path])
+                    if values:
+                        for name, value in values.items():
+                            if name in columns:
+                                row[columns[name]] = value
+                    writer.writerow(row)
+        _replace(part, csvfile)
+        return len(found)
+
+
+class BackgroundWriter:
+    '''
+        Runs any writer backend on its own thread, so output I/O
+        overlaps with hashing. Rows are handed over through a bounded
+        queue; close() drains it and closes the wrapped writer.
+    '''
+
+    def __init__(self, writer, queuesize=10000):
+        self.writer = writer
+        self.queue = queue.Queue(queuesize)
+        self.failed = 0
+        self.thread = threading.Thread(target=self._drain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _drain(self):
+        # keeps draining past a failing writer: writerow() and close()
+        # would otherwise block on the queue forever
+        while True:
+            row = self.queue.get()
+            try:
+                if row is None:
+                    break
+                self.writer.writerow(row)
+            except Exception as error:
+                self.failed += 1
+                logging.error("Background write failed: %s" % error)
+            finally:
+                self.queue.task_done()
+        try:
+            self.writer.close()
+        except Exception as error:
+            self.failed += 1
+            logging.error("Background close failed: %s" % error)
+
+    def writerow(self, row):
+        self.queue.put(row)
+
+    @property
+    def errors(self):
+        return self.writer.errors + self.failed
+
+    def position(self):
+        # once the queue is drained the writer thread is idle
+        self.queue.join()
+        return self.writer.position()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def _sqltext(value):
+    '''
+        A value as sqlite3 can bind it. Python 2 byte strings (paths,
+        labels) are only accepted as ASCII, so they are decoded from
+        UTF-8, or stored as a BLOB of the raw bytes when they are not
+        UTF-8.
+    '''
+    if sys.version_info[0] >= 3 or not isinstance(value, str):
+        return value
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return buffer(value)
+
+
+class SQLiteWriter:
+    '''
+        Appends crawl results to a SQLite database. Every crawl gets a
+        row in the crawls table that its files point back to, so one
+        database can collect many devices and runs. Rows are buffered
+        and inserted in one transaction per batch, as FlushPolicy
+        decides. Timestamps are stored as integer nanoseconds, so
+        timeformat is not used.
+    '''
+    schemalock = threading.Lock()
+
+    def __init__(self, dbfile, source=None, fields=None, flushrows=5000,
+                 flushbytes=1 << 22, flushinterval=5.0, resume=None,
+                 timeformat=None):
+        self.fields = fields = fields or KEYS
+        self.getter = rowgetter(fields)
+        self.rows = []
+        self.count = 0
+        self.errors = 0
+        self.policy = FlushPolicy(flushrows, flushbytes, flushinterval)
+        try:
+            # may be handed to a BackgroundWriter thread
+            self.conn = sqlite3.connect(dbfile, timeout=60,
+                                        check_same_thread=False)
+            # crawls running side by side must not race on the schema
+            with SQLiteWriter.schemalock:
+                self.conn.execute('PRAGMA journal_mode=WAL')
+                self.conn.execute('PRAGMA synchronous=NORMAL')
+                self.conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS crawls (
+                        id INTEGER PRIMARY KEY, source TEXT,
+                        started REAL, finished REAL, files INTEGER);
+                    CREATE TABLE IF NOT EXISTS files (
+                        crawl INTEGER REFERENCES crawls(id));
+                    CREATE INDEX IF NOT EXISTS files_crawl ON files(crawl);''')
+                # add a column for any key this database has not seen yet
+                have = [col[1] for col in
+                        self.conn.execute('PRAGMA table_info(files)')]
+                for key in fields:
+                    if key not in have:
+                        self.conn.execute('ALTER TABLE files '
+                                          'ADD COLUMN %s' % key)
+                for key in ['digest', 'path', 'filetype', 'mtime']:
+                    self.conn.execute('CREATE INDEX IF NOT EXISTS files_%s '
+                                      'ON files(%s)' % (key, key))
+            with self.conn:
+                if resume is not None:
+                    # carry on with the crawl, minus rows written after
+                    # the checkpoint
+                    self.crawl, last = resume
+                    self.conn.execute('DELETE FROM files WHERE crawl = ? '
+                                      'AND rowid > ?', (self.crawl, last))
+                    self.count = self.conn.execute(
+                        'SELECT count(*) FROM files WHERE crawl = ?',
+                        (self.crawl,)).fetchone()[0]
+                else:
+                    self.crawl = self.conn.execute(
+                        'INSERT INTO crawls (source, started) VALUES (?, ?)',
+                        (source, time.time())).lastrowid
+            self.insert = 'INSERT INTO files (crawl, %s) VALUES (?%s)' % (
+                ', '.join(fields), ',?' * len(fields))
+        except sqlite3.Error as error:
+            logging.info("SQLite Database: Initialization Failed")
+            logging.info(error)
+            sys.exit(1)
+
+    def writerow(self, row):
+        row = self.getter(row)
+        self.rows.append((self.crawl,) + tuple(_sqltext(value)
+                                               for value in row))
+        if self.policy.add(row):
+            self.flush()
+
+    def flush(self):
+        try:
+            with self.conn:
+                self.conn.executemany(self.insert, self.rows)
+            self.count += len(self.rows)
+        except sqlite3.Error:
+            # find the bad rows, log and skip them
+            for row in self.rows:
+                try:
+                    with self.conn:
+                        self.conn.execute(self.insert, row)
+                    self.count += 1
+                except sqlite3.Error as error:
+                    self.errors += 1
+                    logging.info("SQLite Database Write: Failed for %r" %
+                                 (row[1],))
+                    logging.info(error)
+        self.rows = []
+        self.policy.reset()
+
+    def position(self):
+        '''
+            Flushes and returns where a resumed crawl picks up.
+        '''
+        self.flush()
+        last = self.conn.execute('SELECT max(rowid) FROM files').fetchone()
+        return [self.crawl, last[0] or 0]
+
+    def close(self):
+        self.flush()
+        with self.conn:
+            self.conn.execute('UPDATE crawls SET finished = ?, files = ? '
+                              'WHERE id = ?',
+                              (time.time(), self.count, self.crawl))
+        self.conn.close()
+
+    @staticmethod
+    def upgrade(dbfile, crawl, results, batchsize=1000):
+        '''
+            Fills results, (path, {field: value}) pairs from the full
+            pass of a triage crawl, into the rows of crawl, committing
+            every batchsize rows so readers see digests arrive as they
+            are computed. Returns the rows upgraded.
+        '''
+        count = 0
+        conn = sqlite3.connect(dbfile, timeout=60)
+        try:
+            for path, values in results:
+                names = sorted(values)
+                # a failing row is logged and skipped, the others kept
+                try:
+                    cursor = conn.execute(
+                        'UPDATE files SET %s WHERE crawl = ? AND path = ?' %
+                        ', '.join('%s = ?' % name for name in names),
+                        [_sqltext(values[name]) for name in names] +
+                        [crawl, _sqltext(path)])
+                except sqlite3.Error as error:
+                    logging.info("SQLite Database Upgrade: Failed for %s" %
+                                 path)
+                    logging.info(error)
+                    continue
+                if cursor.rowcount > 0:
+                    count += 1
+                    if count % batchsize == 0:
+                        conn.commit()
+            conn.commit()
+        except sqlite3.Error as error:
+            logging.info("SQLite Database Upgrade: Failed after %d rows" %
+                         count)
+            logging.info(error)
+        finally:
+            conn.close()
+        return count
+
+
+class ColumnarWriter:
+    '''
+        Writes crawl results in the compact format of columnar.py:
+        sizes and timestamps as int64, digests as raw bytes and file
+        types dictionary-encoded. Each flush becomes one row group, so
+        the flush limits here are much larger than for CSV. Timestamps
+        are kept as nanoseconds, so timeformat is not used.
+    '''
+
+    def __init__(self, fname, source=None, fields=None, flushrows=65536,
+                 flushbytes=1 << 26, flushinterval=60.0, resume=None,
+                 timeformat=None):
+        fields = fields or KEYS
+        self.rows = []
+        self.getter = rowgetter(fields)
+        self.errors = 0
+        self.policy = FlushPolicy(flushrows, flushbytes, flushinterval)
+        types = [columnar.TYPES.get(key, 'bin' if key in HASHES else 'str')
+                 for key in fields]
+        try:
+            self.writer = columnar.Writer(fname, fields, types, source,
+                                          resume)
+        except IOError as error:
+            logging.info("Columnar File: Initialization Failed")
+            logging.info(error)
+            sys.exit(1)
+
+    def writerow(self, row):
+        row = self.getter(row)
+        self.rows.append(row)
+        if self.policy.add(row):
+            self.flush()
+
+    def flush(self):
+        try:
+            self.writer.writegroup(self.rows)
+        except (IOError, ValueError, TypeError) as error:
+            self.errors += len(self.rows)
+            logging.info("Columnar File Write: Failed, dropped %d rows" %
+                         len(self.rows))
+            logging.info(error)
+        self.rows = []
+        self.policy.reset()
+
+    def position(self):
+        '''
+            Flushes and returns where a resumed crawl picks up.
+        '''
+        self.flush()
+        return self.writer.position()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    @staticmethod
+    def upgrade(fname, crawl, results):
+        '''
+            Fills results, (path, {field: value}) pairs from the full
+            pass of a triage crawl, into the rows for those paths. The
+            file is rewritten with the same row groups alongside and
+            renamed over the original. Returns the rows upgraded.
+        '''
+        found = dict(results)
+        if not found:
+            return 0
+        part = fname + '.part'
+        old = columnar.ColumnarFile(fname)
+        try:
+            data = old.read()
+            paths = data['path']
+            names = set(name for values in found.values() for name in values)
+            for name in names & set(old.fields):
+                column = list(data[name])
+                for num, path in enumerate(paths):
+                    values = found.get(path)
+                    if values:
+                        column[num] = values[name]
+                data[name] = column
+            writer = columnar.Writer(part, old.fields,
+                                     [old.types[name] for name in old.fields],
+                                     old.source)
+            columns = list(data.values())
+            start = 0
+            for rows, _ in old.groups:
+                writer.writegroup(list(zip(*[column[start:start + rows]
+                                             for column in columns])))
+                start += rows
+            writer.close()
+        finally:
+            old.close()
+        _replace(part, fname)
+        return len(found)
+
+
+# output backends for write_data; each takes (filename, source, fields,
+# resume=position, timeformat=TimeFormatter) and provides writerow(),
+# position() and close(), and a static upgrade(filename, crawl, results)
+# for the full pass of triage crawls
+WRITERS = {'csv': CSVWriter, 'sqlite': SQLiteWriter,
+           'columnar': ColumnarWriter}
+# file name suffix for the backends that write a file per crawl
+SUFFIXES = {'csv': '.csv', 'columnar': '.fcol'}
+
+
+def _replace(part, fname):
+    # os.rename does not replace an existing file on Windows
+    if os.name == 'nt' and os.path.exists(fname):
+        os.remove(fname)
+    os.rename(part, fname)
+
+
+_STATNAMES = dict((name, ('st_%s_ns' % name, 'st_' + name))
+                  for name in TIMES)
+
+
+def _time_ns(st, name='mtime'):
+    # st_*_ns only exists on Python 3; elsewhere the float has to do
+    nsname, secname = _STATNAMES[name]
+    ns = getattr(st, nsname, None)
+    if ns is None:
+        ns = int(round(getattr(st, secname) * 1e9))
+    return ns
+
+
+class DigestCache:
+    '''
+        Persistent per-file cache of digests and file type. Entries are
+        keyed on (device, inode) and only reused while the file's size
+        and mtime_ns still match, so a changed file simply misses and
+        is overwritten. Removable volumes get new device numbers, and
+        on FAT new inode numbers, every time they are mounted, so with
+        volume set (a DeviceRegistry key) entries are keyed on the
+        volume and the path below root instead. With full set, lookups
+        always miss but fresh results are still stored. Lookups happen
+        wherever the task generator runs, the feeding thread of a
+        worker pool included, while results are stored from the
+        writing thread.
+    '''
+
+    def __init__(self, dbfile, full=False, batchsize=1000, volume=None,
+                 root=None):
+        self.full = full
+        self.batchsize = batchsize
+        self.volume = volume
+        self.prefix = os.path.join(root, '') if root else None
+        self.pending = 0
+        self.session = time.time()
+        self.lock = threading.Lock()
+        # concurrent USB crawls may share the cache file
+        self.conn = sqlite3.connect(dbfile, timeout=60,
+                                    check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                digest TEXT, filetype TEXT, seen REAL,
+                PRIMARY KEY (dev, ino));
+            CREATE TABLE IF NOT EXISTS volumefiles (
+                volume TEXT, path TEXT, size INTEGER, mtime_ns INTEGER,
+                digest TEXT, filetype TEXT, seen REAL,
+                PRIMARY KEY (volume, path));''')
+
+    def _key(self, st, path):
+        # (table, key values) of the entry for a file
+        if self.volume is None:
+            return 'files', ('dev', 'ino'), (st.st_dev, st.st_ino)
+        if path is None or not path.startswith(self.prefix):
+            return None
+        return ('volumefiles', ('volume', 'path'),
+                (self.volume, _sqltext(path[len(self.prefix):])))
+
+    def get(self, st, hashes=('md5',), path=None):
+        '''
+            Returns (filetype, digests) if st matches a cached entry that
+            has every algorithm in hashes. path is needed with volume.
+        '''
+        key = None if self.full or st is None else self._key(st, path)
+        if key is None:
+            return None
+        table, names, values = key
+        where = '%s = ? AND %s = ?' % names
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime_ns, filetype, digest FROM %s '
+                'WHERE %s' % (table, where), values).fetchone()
+            if row is None or row[:2] != (st.st_size, _time_ns(st)):
+                return None
+            digests = self._decode(row[3])
+            if not all(name in digests for name in hashes):
+                return None
+            self.conn.execute('UPDATE %s SET seen = ? WHERE %s' %
+                              (table, where), (self.session,) + values)
+            self._tick()
+        return row[2], digests
+
+    def put(self, st, filetype, digests, path=None):
+        key = None if st is None else self._key(st, path)
+        if key is None:
+            return
+        table, _, values = key
+        digest = ','.join('%s=%s' % item for item in sorted(digests.items()))
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO %s '
+                              'VALUES (?,?,?,?,?,?,?)' % table,
+                              values + (st.st_size, _time_ns(st),
+                                        digest, filetype, self.session))
+            self._tick()
+
+    @staticmethod
+    def _decode(digest):
+        # entries written before multi-hash support hold a bare md5
+        if '=' not in digest:
+            return {'md5': digest}
+        return dict(item.split('=') for item in digest.split(','))
+
+    def _tick(self):
+        # commit in batches rather than once per file
+        self.pending += 1
+        if self.pending >= self.batchsize:
+            self.conn.commit()
+            self.pending = 0
+
+    def compact(self, maxage):
+        '''
+            Drops entries not seen for maxage seconds and reclaims space.
+        '''
+        for table in ('files', 'volumefiles'):
+            self.conn.execute('DELETE FROM %s WHERE seen < ?' % table,
+                              (self.session - maxage,))
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class RollupStore:
+    '''
+        Per-crawl Merkle summaries of a tree, kept in SQLite. Every
+        directory a crawl visits is recorded with its stat, and every
+        file with its size, mtime, digest and whole record, by path
+        relative to the crawled source. finish() then rolls each
+        directory up into one hash over its files' names, sizes, mtimes
+        and digests and its subdirectories' names and rollups, so two
+        crawls can be compared from the top down, see diff().
+
+        With skip set, a directory whose mtime and ctime are unchanged
+        since the last finished crawl of the same source is not listed:
+        its entries cannot have been added, removed or renamed, so its
+        files are carried over from that crawl and its subdirectories
+        are taken from there and checked the same way. Only files
+        rewritten in place, which changes no directory, go unnoticed.
+        Crawls made with other options are never carried over from, nor
+        are directories with a file a triage crawl left without digest.
+
+        Paths are stored as their raw bytes, whatever their encoding.
+    '''
+
+    def __init__(self, dbfile, batchsize=1000):
+        self.batchsize = batchsize
+        self.pending = 0
+        self.lock = threading.Lock()
+        # walker threads record directories, the writing thread files
+        self.conn = sqlite3.connect(dbfile, timeout=60,
+                                    check_same_thread=False)
+        with SQLiteWriter.schemalock:
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS crawls (
+                    id INTEGER PRIMARY KEY, source BLOB, started REAL,
+                    finished REAL, files INTEGER, options TEXT);
+                CREATE TABLE IF NOT EXISTS dirs (
+                    crawl INTEGER, path BLOB, parent BLOB,
+                    mtime_ns INTEGER, ctime_ns INTEGER, rollup TEXT,
+                    PRIMARY KEY (crawl, path));
+                CREATE INDEX IF NOT EXISTS dirs_parent
+                    ON dirs(crawl, parent);
+                CREATE TABLE IF NOT EXISTS files (
+                    crawl INTEGER, dir BLOB, name BLOB, filesize INTEGER,
+                    mtime INTEGER, digest TEXT, record TEXT,
+                    PRIMARY KEY (crawl, dir, name));''')
+            columns = [row[1] for row in
+                       self.conn.execute('PRAGMA table_info(crawls)')]
+            if 'options' not in columns:
+                self.conn.execute('ALTER TABLE crawls ADD COLUMN '
+                                  'options TEXT')
+
+    @staticmethod
+    def _blob(path):
+        if sys.version_info[0] >= 3:
+            return os.fsencode(path)
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return buffer(path)
+
+    @staticmethod
+    def _path(blob):
+        if sys.version_info[0] >= 3:
+            return os.fsdecode(bytes(blob))
+        return str(blob)
+
+    def begin(self, source, skip=False, options=None):
+        '''
+            Starts recording a crawl of source; returns its id. options
+            is a string describing what the crawl records: only a crawl
+            with the same options is carried over from.
+        '''
+        self.source = source
+        self.prefix = os.path.join(source, '')
+        self.previous = None
+        if skip:
+            row = self.conn.execute(
+                'SELECT max(id) FROM crawls WHERE source = ? AND '
+                'options IS ? AND finished IS NOT NULL',
+                (self._blob(source), options)).fetchone()
+            self.previous = row[0]
+        self.carried = []
+        with self.conn:
+            self.crawl = self.conn.execute(
+                'INSERT INTO crawls (source, started, options) '
+                'VALUES (?, ?, ?)',
+                (self._blob(source), time.time(), options)).lastrowid
+        return self.crawl
+
+    def relative(self, path):
+        return '' if path == self.source else path[len(self.prefix):]
+
+    def unchanged(self, dirpath, st):
+        '''
+            Walker hook, called with the stat of every directory before
+            it is listed. Returns the names of its subdirectories if it
+            is unchanged since the previous crawl, having carried its
+            files over, or None if it has to be listed.
+        '''
+        rel = self.relative(dirpath)
+        key = self._blob(rel)
+        parent = self._blob(os.path.dirname(rel)) if rel else None
+        stamps = (_time_ns(st, 'mtime'), _time_ns(st, 'ctime'))
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO dirs (crawl, path, '
+                              'parent, mtime_ns, ctime_ns) '
+                              'VALUES (?,?,?,?,?)',
+                              (self.crawl, key, parent) + stamps)
+            self._tick()
+            if self.previous is None:
+                return None
+            # inode numbers are left out: FAT makes new ones per mount
+            row = self.conn.execute(
+                'SELECT mtime_ns, ctime_ns FROM dirs WHERE crawl = ? AND '
+                'path = ?', (self.previous, key)).fetchone()
+            if row is None or tuple(row) != stamps:
+                return None
+            # a triage crawl's deferred digests were never stored here
+            if self.conn.execute(
+                    'SELECT 1 FROM files WHERE crawl = ? AND dir = ? AND '
+                    'digest IS NULL LIMIT 1',
+                    (self.previous, key)).fetchone():
+                return None
+            self.conn.execute(
+                'INSERT OR REPLACE INTO files SELECT ?, dir, name, '
+                'filesize, mtime, digest, record FROM files '
+                'WHERE crawl = ? AND dir = ?', (self.crawl, self.previous,
+                                                key))
+            self.carried.append(rel)
+            return [os.path.basename(self._path(path)) for (path,)
+                    in self.conn.execute('SELECT path FROM dirs WHERE '
+                                         'crawl = ? AND parent = ?',
+                                         (self.previous, key))]
+
+    def add(self, record):
+        rel, name = os.path.split(self.relative(record.path))
+        state = dict((key, value) for key, value in
+                     zip(Record.__slots__, record.values())
+                     if value is not None and key != 'path')
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO files '
+                              'VALUES (?,?,?,?,?,?,?)',
+                              (self.crawl, self._blob(rel), self._blob(name),
+                               record.filesize, record.mtime, record.digest,
+                               json.dumps(state)))
+            self._tick()
+
+    def carriedover(self):
+        '''
+            Records for the files of unchanged directories, rebuilt from
+            the previous crawl under this crawl's source.
+        '''
+        for rel in self.carried:
+            rows = self.conn.execute('SELECT name, record FROM files '
+                                     'WHERE crawl = ? AND dir = ?',
+                                     (self.crawl, self._blob(rel))).fetchall()
+            for name, state in rows:
+                record = Record(os.path.join(self.source, rel,
+                                             self._path(name)))
+                for key, value in json.loads(state).items():
+                    setattr(record, key, value)
+                yield record
+
+    def _tick(self):
+        self.pending += 1
+        if self.pending >= self.batchsize:
+            self.conn.commit()
+            self.pending = 0
+
+    def finish(self, files):
+        '''
+            Computes the rollup of every directory of the crawl, deepest
+            first, and marks it finished so later crawls can build on
+            it.
+        '''
+        with self.lock:
+            self.conn.commit()
+            filehash = {}
+            current, hasher = None, None
+            for rel, name, size, mtime, digest in self.conn.execute(
+                    'SELECT dir, name, filesize, mtime, digest FROM files '
+                    'WHERE crawl = ? ORDER BY dir, name', (self.crawl,)):
+                rel = bytes(rel)
+                if rel != current:
+                    current, hasher = rel, hashlib.md5()
+                    filehash[rel] = hasher
+                hasher.update(bytes(name) + ('\0%s\0%s\0%s\n' % (
+                    size, mtime, digest or '')).encode('ascii'))
+            children = {}
+            dirs = [bytes(path) for (path,) in self.conn.execute(
+                'SELECT path FROM dirs WHERE crawl = ?', (self.crawl,))]
+            for path in dirs:
+                if path:
+                    children.setdefault(os.path.dirname(path),
+                                        []).append(path)
+            rollups = {}
+            # a child's path is always longer than its parent's
+            for path in sorted(dirs, key=len, reverse=True):
+                hasher = hashlib.md5(filehash[path].hexdigest().encode('ascii')
+                                     if path in filehash else b'')
+                for child in sorted(children.get(path, ())):
+                    hasher.update(os.path.basename(child) + b'\0' +
+                                  rollups[child].encode('ascii') + b'\n')
+                rollups[path] = hasher.hexdigest()
+            with self.conn:
+                self.conn.executemany(
+                    'UPDATE dirs SET rollup = ? WHERE crawl = ? AND path = ?',
+                    [(rollup, self.crawl, self._blob(path))
+                     for path, rollup in rollups.items()])
+                self.conn.execute('UPDATE crawls SET finished = ?, files = ? '
+                                  'WHERE id = ?',
+                                  (time.time(), files, self.crawl))
+        return rollups.get(b'')
+
+    def crawls(self, source=None):
+        '''
+            (id, source, started, files) of finished crawls, oldest
+            first, of source or all.
+        '''
+        query = 'SELECT id, source, started, files FROM crawls ' \
+                'WHERE finished IS NOT NULL'
+        if source is None:
+            rows = self.conn.execute(query + ' ORDER BY id')
+        else:
+            rows = self.conn.execute(query + ' AND source = ? ORDER BY id',
+                                     (self._blob(source),))
+        return [(crawl, self._path(found), started, files)
+                for crawl, found, started, files in rows]
+
+    def _files(self, crawl, rel):
+        return dict((self._path(name), (size, mtime, digest))
+                    for name, size, mtime, digest in self.conn.execute(
+                        'SELECT name, filesize, mtime, digest FROM files '
+                        'WHERE crawl = ? AND dir = ?',
+                        (crawl, self._blob(rel))))
+
+    def _subdirs(self, crawl, rel):
+        return dict((self._path(path), rollup) for path, rollup
+                    in self.conn.execute('SELECT path, rollup FROM dirs '
+                                         'WHERE crawl = ? AND parent = ?',
+                                         (crawl, self._blob(rel))))
+
+    def _subtree(self, crawl, rel):
+        # every file at or below rel: its path range in the index
+        for found, name, size, mtime, digest in self.conn.execute(
+                'SELECT dir, name, filesize, mtime, digest FROM files '
+                'WHERE crawl = ? AND (dir = ? OR (dir > ? AND dir < ?))',
+                (crawl, self._blob(rel), self._blob(rel + os.sep),
+                 self._blob(rel + chr(ord(os.sep) + 1)))):
+            yield (self._path(found), self._path(name), size, mtime,
+                   digest)
+
+    def diff(self, old, new):
+        '''
+            Yields (change, path, old, new) for every file added,
+            removed or modified between crawls old and new, with old
+            and new the (filesize, mtime, digest) on either side or
+            None. Only directories whose rollups differ are opened, so
+            the work follows the size of the change, not of the tree.
+            A digest missing on either side is not compared.
+        '''
+        def rollup(crawl, rel):
+            row = self.conn.execute('SELECT rollup FROM dirs WHERE '
+                                    'crawl = ? AND path = ?',
+                                    (crawl, self._blob(rel))).fetchone()
+            return row and row[0]
+
+        def join(rel, name):
+            return os.path.join(rel, name) if rel else name
+
+        def differ(was, now):
+            # triage crawls leave the digests of large files empty
+            if was[:2] != now[:2]:
+                return True
+            return None not in (was[2], now[2]) and was[2] != now[2]
+
+        top = rollup(new, '')
+        if top is not None and rollup(old, '') == top:
+            return
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            before, after = self._files(old, rel), self._files(new, rel)
+            for name in sorted(set(before) | set(after)):
+                was, now = before.get(name), after.get(name)
+                if was is None:
+                    yield 'added', join(rel, name), None, now
+                elif now is None:
+                    yield 'removed', join(rel, name), was, None
+                elif differ(was, now):
+                    yield 'modified', join(rel, name), was, now
+            before, after = self._subdirs(old, rel), self._subdirs(new, rel)
+            for path in sorted(set(before) | set(after), reverse=True):
+                if path in before and path in after:
+                    if before[path] != after[path]:
+                        pending.append(path)
+                    continue
+                change, crawl = ('added', new) if path in after \
+                    else ('removed', old)
+                for rel2, name, size, mtime, digest in \
+                        self._subtree(crawl, path):
+                    found = (size, mtime, digest)
+                    yield (change, join(rel2, name),
+                           None if change == 'added' else found,
+                           found if change == 'added' else None)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class Checkpoint:
+    '''
+        Crawl progress saved to a small JSON state file, so an
+        interrupted crawl can be resumed. A directory is recorded as
+        done once it has been listed and all of its files written;
+        until then its written files are recorded by name. Together
+        with the writer's position at the time of saving, that lets a
+        resumed crawl skip finished work and drop rows written after
+        the last save. Tasks are dispatched and directories listed on
+        the pool's feeding thread while rows are written on another,
+        so the bookkeeping is done under a lock.
+    '''
+
+    def __init__(self, statefile, interval=60.0):
+        self.statefile = statefile
+        self.interval = interval
+        self.saved = time.time()
+        self.state = {'donedirs': [], 'donefiles': {}}
+        self.pending = {}
+        self.listing = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _encode(path):
+        # JSON only holds text: Python 2 byte strings are stored as
+        # latin-1, which maps every byte to a character and back
+        if sys.version_info[0] < 3 and isinstance(path, str):
+            return path.decode('latin-1')
+        return path
+
+    @staticmethod
+    def _decode(path):
+        if sys.version_info[0] < 3:
+            return path.encode('latin-1')
+        return path
+
+    def load(self):
+        with open(self.statefile) as f:
+            state = json.load(f)
+        decode = self._decode
+        for key in ('source', 'output'):
+            if state.get(key) is not None:
+                state[key] = decode(state[key])
+        state['donedirs'] = [decode(d) for d in state['donedirs']]
+        state['donefiles'] = dict((decode(d), [decode(name) for name in
+                                               names])
+                                  for d, names in state['donefiles'].items())
+        self.state = state
+        return self.state
+
+    def start(self, source, output, fmt):
+        self.state.update(source=source, output=output, fmt=fmt)
+        self.donedirs = set(self.state['donedirs'])
+        self.donefiles = dict((d, set(names)) for d, names in
+                              self.state['donefiles'].items())
+
+    def isdone(self, path):
+        dirpath, name = os.path.split(path)
+        with self.lock:
+            return (dirpath in self.donedirs or
+                    name in self.donefiles.get(dirpath, ()))
+
+    def track(self, tasks):
+        '''
+            Passes (path, stat) tasks through, noting each as dispatched.
+        '''
+        for path, st in tasks:
+            self.dispatched(path)
+            yield path, st
+
+    def dispatched(self, path):
+        dirpath = os.path.dirname(path)
+        with self.lock:
+            self.pending[dirpath] = self.pending.get(dirpath, 0) + 1
+
+    def listed(self, dirpath):
+        with self.lock:
+            self.listing.add(dirpath)
+            self._complete(dirpath)
+
+    def written(self, path):
+        dirpath, name = os.path.split(path)
+        with self.lock:
+            self.pending[dirpath] -= 1
+            self.donefiles.setdefault(dirpath, set()).add(name)
+            self._complete(dirpath)
+
+    def _complete(self, dirpath):
+        if dirpath in self.listing and not self.pending.get(dirpath):
+            self.listing.discard(dirpath)
+            self.pending.pop(dirpath, None)
+            self.donefiles.pop(dirpath, None)
+            self.donedirs.add(dirpath)
+
+    def due(self):
+        return time.time() - self.saved >= self.interval
+
+    def save(self, position):
+        '''
+            Atomically writes the state; position must come from the
+            writer after all rows counted as written were flushed.
+        '''
+        encode = self._encode
+        with self.lock:
+            donedirs = sorted(encode(d) for d in self.donedirs)
+            donefiles = dict((encode(d), sorted(encode(name)
+                                                for name in names))
+                             for d, names in self.donefiles.items())
+        state = dict(self.state, position=position, donedirs=donedirs,
+                     donefiles=donefiles)
+        for key in ('source', 'output'):
+            if state.get(key) is not None:
+                state[key] = encode(state[key])
+        temp = self.statefile + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(state, f)
+        os.rename(temp, self.statefile)
+        self.saved = time.time()
+
+    def finish(self):
+        if os.path.exists(self.statefile):
+            os.remove(self.statefile)
+
+
+class Histogram:
+    '''
+        Counts durations in power-of-two buckets of microseconds, so
+        millions of samples take a few dozen integers.
+    '''
+
+    def __init__(self):
+        self.counts = [0] * 40
+        self.total = 0.0
+        self.n = 0
+
+    def add(self, seconds):
+        bucket = int(seconds * 1e6).bit_length()
+        self.counts[min(bucket, len(self.counts) - 1)] += 1
+        self.total += seconds
+        self.n += 1
+
+    def quantile(self, q):
+        '''
+            Upper bound, in seconds, of the bucket holding quantile q.
+        '''
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= q * self.n:
+                return (1 << bucket) / 1e6
+        return 0.0
+
+    def summary(self):
+        return {'count': self.n, 'seconds': round(self.total, 6),
+                'mean_ms': round(self.total / self.n * 1e3, 3)
+                if self.n else None,
+                'p50_ms': self.quantile(0.5) * 1e3,
+                'p95_ms': self.quantile(0.95) * 1e3,
+                'buckets_us': dict((1 << bucket, count) for bucket, count
+                                   in enumerate(self.counts) if count)}
+
+
+class CrawlStats:
+    '''
+        Per-stage timings, bytes read and errors for one crawl. Tasks
+        report what getmetadata measured through add(); the writer
+        stage is timed by write_data itself. start() reports on a
+        background thread every interval seconds, as a progress line on
+        stderr and/or a JSON stats file, until stop().
+    '''
+    STAGES = ['stat', 'hash', 'magic', 'write']
+
+    def __init__(self, source):
+        self.source = source
+        self.started = time.time()
+        self.files = 0
+        self.bytes = 0
+        self.errors = {}
+        self.stages = dict((stage, Histogram()) for stage in self.STAGES)
+        self.profile = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.thread = None
+
+    def time(self, stage, seconds):
+        with self.lock:
+            self.stages[stage].add(seconds)
+
+    def error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def add(self, timings):
+        '''
+            Takes the timings dict filled in by _metadata_task.
+        '''
+        with self.lock:
+            for stage in ('hash', 'magic'):
+                if stage in timings:
+                    self.stages[stage].add(timings[stage])
+            self.bytes += timings.get('bytes', 0)
+            if 'error' in timings:
+                kind = timings['error']
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+            if 'profile' in timings:
+                if self.profile is None:
+                    self.profile = pstats.Stats(_Profiled(timings['profile']))
+                else:
+                    self.profile.add(_Profiled(timings['profile']))
+
+    def wrote(self, seconds):
+        with self.lock:
+            self.stages['write'].add(seconds)
+            self.files += 1
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            return {'source': self.source, 'elapsed': round(elapsed, 3),
+                    'files': self.files, 'bytes': self.bytes,
+                    'files_per_s': round(self.files / elapsed, 1)
+                    if elapsed else None,
+                    'mb_per_s': round(self.bytes / 1e6 / elapsed, 2)
+                    if elapsed else None,
+                    'errors': dict(self.errors),
+                    'stages': dict((stage, hist.summary()) for stage, hist
+                                   in self.stages.items())}
+
+    def line(self):
+        snap = self.snapshot()
+        means = " ".join("%s %.2f" % (stage,
+                                      snap['stages'][stage]['mean_ms'] or 0)
+                         for stage in self.STAGES)
+        return ("%s: %d files, %.1f files/s, %.1f MB/s, %d errors | "
+                "ms/file %s" % (self.source, snap['files'],
+                                snap['files_per_s'] or 0,
+                                snap['mb_per_s'] or 0,
+                                sum(snap['errors'].values()), means))
+
+    def save(self, statsfile):
+        temp = statsfile + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.rename(temp, statsfile)
+
+    def report(self, progress=False, statsfile=None):
+        if progress:
+            sys.stderr.write("\r" + self.line())
+            sys.stderr.flush()
+        if statsfile:
+            try:
+                self.save(statsfile)
+            except (IOError, OSError) as error:
+                logging.info("Stats File: Write Failed")
+                logging.info(error)
+
+    def start(self, progress=False, statsfile=None, interval=1.0):
+        def loop():
+            while not self.done.wait(interval):
+                self.report(progress, statsfile)
+        if progress or statsfile:
+            self.thread = threading.Thread(target=loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, progress=False, statsfile=None):
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report(progress, statsfile)
+        if progress:
+            sys.stderr.write("\n")
+
+
+class _Profiled(object):
+    # lets pstats load the raw stats dict a (possibly remote) profile made
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class DeviceRegistry:
+    '''
+        Durable record of the volumes crawled in USB mode: their uuid,
+        when they were last crawled (and last crawled in full), how
+        many files they held and a fingerprint of their top level. The
+        fingerprint covers the free block and inode counts, which move
+        on any write anywhere on the volume, plus the root directory
+        listing, so deciding whether a known drive changed costs a
+        statvfs and a few stats rather than a crawl.
+    '''
+
+    def __init__(self, dbfile, fullevery=None):
+        self.fullevery = fullevery
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbfile, timeout=60,
+                                    check_same_thread=False)
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS devices (
+                                    key TEXT PRIMARY KEY, uuid TEXT,
+                                    volume TEXT, mount_point TEXT,
+                                    crawled REAL, fullcrawl REAL,
+                                    fingerprint TEXT, files INTEGER)''')
+
+    @staticmethod
+    def key(mnt, vol, uuid):
+        # a volume uuid survives remounting elsewhere; fall back on names
+        if uuid:
+            return _sqltext(uuid)
+
+        def raw(value):
+            # Python 2 byte strings are hashed as they are
+            if isinstance(value, bytes):
+                return value
+            return (u'%s' % (value,)).encode('utf-8')
+        return hashlib.md5(raw(mnt) + b'-' + raw(vol)).hexdigest()
+
+    @staticmethod
+    def fingerprint(mnt):
+        fingerprint = hashlib.md5()
+        vfs = os.statvfs(mnt)
+        fingerprint.update(repr((vfs.f_blocks, vfs.f_bfree,
+                                 vfs.f_files, vfs.f_ffree)).encode('utf-8'))
+        for entry in sorted(scandir(mnt), key=lambda entry: entry.name):
+            st = entry.stat(follow_symlinks=False)
+            fingerprint.update(repr((entry.name, st.st_mode, st.st_size,
+                                     _time_ns(st))).encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    def check(self, key, fingerprint):
+        '''
+            'full' for a new volume or one due a periodic full crawl,
+            'skip' if its fingerprint is unchanged, else 'incremental'.
+        '''
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT fingerprint, fullcrawl FROM devices WHERE key = ?',
+                (key,)).fetchone()
+        if row is None:
+            return 'full'
+        if self.fullevery is not None and (
+                row[1] is None or time.time() - row[1] > self.fullevery):
+            return 'full'
+        if row[0] == fingerprint:
+            return 'skip'
+        return 'incremental'
+
+    def record(self, key, uuid, vol, mnt, fingerprint, files, full):
+        now = time.time()
+        with self.lock, self.conn:
+            previous = self.conn.execute(
+                'SELECT fullcrawl FROM devices WHERE key = ?',
+                (key,)).fetchone()
+            fullcrawl = now if full else previous and previous[0]
+            self.conn.execute(
+                'INSERT OR REPLACE INTO devices VALUES (?,?,?,?,?,?,?,?)',
+                (key, _sqltext(uuid), _sqltext(vol), _sqltext(mnt), now,
+                 fullcrawl, fingerprint, files))
+
+
+REGISTRY = None
+
+
+# hex length of a digest -> algorithm, for telling what a hash list holds
+HEXLENGTHS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+
+class _Records(object):
+    '''
+        Read-only sequence over count fixed-width records stored at
+        offset in data, so bisect can search them in place.
+    '''
+
+    def __init__(self, data, offset, width, count):
+        self.data, self.offset = data, offset
+        self.width, self.count = width, count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        start = self.offset + index * self.width
+        return self.data[start:start + self.width]
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+
+class HashSet:
+    '''
+        Known-hash list (NSRL RDS or one hash per line, optionally
+        followed by ,ID) held as a sorted array of raw digests with a
+        Bloom filter in front, so tens of millions of entries take
+        little more than their binary size. The index is built once
+        into listfile + '.idx' and memory-mapped on later runs, and is
+        rebuilt whenever the list is newer or the index is unreadable.
+    '''
+    MAGIC = b'FILERHS1'
+    HEADER = struct.Struct('<16sIQQI')
+    BATCH = 1000000
+
+    def __init__(self, listfile, status, name=None):
+        self.status = status
+        self.listfile = listfile
+        self.name = name or os.path.basename(listfile)
+        indexfile = listfile + '.idx'
+        if (not os.path.exists(indexfile) or
+                os.stat(indexfile).st_mtime < os.stat(listfile).st_mtime):
+            logging.info("Building hash set index %s" % indexfile)
+            self.build(listfile, indexfile)
+        try:
+            self.load(indexfile)
+        except ValueError as error:
+            logging.info("Rebuilding hash set index: %s" % error)
+            self.build(listfile, indexfile)
+            self.load(indexfile)
+
+    @staticmethod
+    def _parse(listfile):
+        # yields raw digests, skipping comments and the NSRL header
+        with open(listfile) as f:
+            for line in f:
+                field = line.split(',', 1)[0].strip().strip('"')
+                if not field or field.startswith('#') or field == 'SHA-1':
+                    continue
+                try:
+                    yield binascii.unhexlify(field.lower())
+                except (TypeError, ValueError):
+                    logging.info("Bad hash in %s: %s" % (listfile, field))
+
+    def build(self, listfile, indexfile):
+        '''
+            Sorts the list in batches of BATCH digests, then merges the
+            batches straight into indexfile, dropping duplicates and
+            filling the Bloom filter on the way. The index is written
+            alongside and renamed over indexfile once complete, so an
+            interrupted build never leaves a partial one behind.
+        '''
+        batches, batch, width = [], [], None
+        for digest in self._parse(listfile):
+            if width is None:
+                width = len(digest)
+            elif len(digest) != width:
+                continue
+            batch.append(digest)
+            if len(batch) >= self.BATCH:
+                batch.sort()
+                batches.append(b''.join(batch))
+                batch = []
+        batch.sort()
+        batches.append(b''.join(batch))
+        width = width or 16
+        total = sum(len(each) for each in batches) // width
+        # about 10 bits per entry, 7 probes: ~1% false positives
+        nbits, probes = max(64, total * 10), 7
+        bloom = bytearray((nbits + 7) // 8)
+        algorithm = HEXLENGTHS.get(width * 2, '')
+        count, last = 0, None
+        part = indexfile + '.tmp'
+        with open(part, 'wb') as out:
+            out.write(self.MAGIC + b'\0' * self.HEADER.size)
+            runs = [_Records(each, 0, width, len(each) // width)
+                    for each in batches]
+            for digest in heapq.merge(*runs):
+                if digest == last:
+                    continue
+                out.write(digest)
+                for bit in self._probes(digest, nbits, probes):
+                    bloom[bit >> 3] |= 1 << (bit & 7)
+                count, last = count + 1, digest
+            out.write(bloom)
+            out.seek(len(self.MAGIC))
+            out.write(self.HEADER.pack(algorithm.encode('ascii'), width,
+                                       count, nbits, probes))
+        _replace(part, indexfile)
+
+    def load(self, indexfile):
+        with open(indexfile, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(self.MAGIC)] != self.MAGIC:
+            self.data.close()
+            raise ValueError("%s is not a hash set index" % indexfile)
+        algorithm, width, count, nbits, probes = self.HEADER.unpack_from(
+            self.data, len(self.MAGIC))
+        self.algorithm = algorithm.rstrip(b'\0').decode('ascii')
+        offset = len(self.MAGIC) + self.HEADER.size
+        # a zeroed header or short file would silently match nothing
+        if (not width or not self.algorithm or not nbits or not probes or
+                len(self.data) < offset + width * count + (nbits + 7) // 8):
+            self.data.close()
+            raise ValueError("%s is an incomplete hash set index" %
+                             indexfile)
+        self.nbits, self.probes = nbits, probes
+        self.records = _Records(self.data, offset, width, count)
+        self.bloom = offset + width * count
+
+    @staticmethod
+    def _probes(digest, nbits, probes):
+        # digests are already uniform, so double hashing on two of
+        # their 64 bit words gives the Bloom filter positions
+        first, second = struct.unpack_from('<QQ', digest)
+        return [(first + i * second) % nbits for i in range(probes)]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, hexdigest):
+        digest = binascii.unhexlify(hexdigest)
+        for bit in self._probes(digest, self.nbits, self.probes):
+            pos = self.bloom + (bit >> 3)
+            if not ord(self.data[pos:pos + 1]) & (1 << (bit & 7)):
+                return False
+        index = bisect.bisect_left(self.records, digest)
+        return index < len(self.records) and self.records[index] == digest
+
+
+def matchhashsets(digests, hashsets):
+    '''
+        Checks {algorithm: hexdigest} against every HashSet. Returns the
+        match status, 'bad' winning over 'good', and the names of the
+        matching sets, or ('', '') when nothing matches.
+    '''
+    found = [hs for hs in hashsets
+             if hs.algorithm in digests and digests[hs.algorithm] in hs]
+    if not found:
+        return '', ''
+    status = 'bad' if any(hs.status == 'bad' for hs in found) else 'good'
+    return status, ';'.join(hs.name for hs in found)
+
+
+def scantree(top, maxdepth=None, prune=None, followlinks=False,
+             skip=None, listed=None, unchanged=None):
+    '''
+        Lazily walks top with scandir, yielding a DirEntry for each file.
+        Directories are visited depth first from an explicit stack, so
+        only pending directory paths are held in memory, never the list
+        of files. maxdepth limits how far below top we descend, names
+        matching any of the prune patterns are skipped, and symlinked
+        directories are only followed when followlinks is set; symlinked
+        files are always yielded and stand for their target. Files for
+        which skip(path) is true are left out, and listed(dirpath) is
+        called once all of a directory's files have been yielded.
+        unchanged(dirpath, stat), if given, is asked about every
+        directory before it is listed; when it returns the names of the
+        subdirectories instead of None, the directory is not listed and
+        only those are visited.
+    '''
+    prune = prune or []
+    seen = set()
+    pending = [(top, 0, _dirstat(top) if unchanged else None)]
+    while pending:
+        dirpath, depth, dirst = pending.pop()
+        names = unchanged(dirpath, dirst) if dirst is not None else None
+        if names is not None:
+            for path, st in _subdirs(dirpath, names, depth, maxdepth, prune,
+                                     followlinks, seen):
+                pending.append((path, depth + 1, st))
+            if listed is not None:
+                listed(dirpath)
+            continue
+        try:
+            entries = scandir(dirpath)
+        except OSError as error:
+            logging.info('Error scanning %s: %s' % (dirpath, error))
+            continue
+        for entry in entries:
+            if any(fnmatch(entry.name, pat) for pat in prune):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=followlinks):
+                    if maxdepth is not None and depth >= maxdepth:
+                        continue
+                    st = None
+                    if followlinks or unchanged:
+                        st = _statdir(entry.path, followlinks)
+                    if followlinks:
+                        # guard against symlink loops
+                        if (st.st_dev, st.st_ino) in seen:
+                            continue
+                        seen.add((st.st_dev, st.st_ino))
+                    pending.append((entry.path, depth + 1,
+                                    st if unchanged else None))
+                elif entry.is_file():
+                    if skip is None or not skip(entry.path):
+                        yield entry
+            except OSError as error:
+                logging.info('Error reading %s: %s' % (entry.path, error))
+        if listed is not None:
+            listed(dirpath)
+
+
+def _statdir(path, followlinks):
+    # directories are always stat'ed by path, never through DirEntry:
+    # the Python 2 backport has whole nanoseconds where os.stat only
+    # has a float, and unchanged compares stamps across crawls
+    return os.stat(path) if followlinks else os.lstat(path)
+
+
+def _dirstat(path):
+    try:
+        return os.stat(path)
+    except OSError as error:
+        logging.info('Error reading %s: %s' % (path, error))
+
+
+def _subdirs(dirpath, names, depth, maxdepth, prune, followlinks, seen,
+             hold=None):
+    '''
+        (path, stat) of the named subdirectories of dirpath that the
+        walkers would have entered, for a directory that unchanged
+        spared them from listing. hold(), if given, is held around each
+        stat call.
+    '''
+    if maxdepth is not None and depth >= maxdepth:
+        return
+    for name in names:
+        if any(fnmatch(name, pat) for pat in prune):
+            continue
+        path = os.path.join(dirpath, name)
+        try:
+            with hold() if hold else _NOLIMIT:
+                st = _statdir(path, followlinks)
+        except OSError as error:
+            logging.info('Error reading %s: %s' % (path, error))
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        if followlinks:
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+        yield path, st
+
+
+def getfilepaths(pth, **kwargs):
+    '''
+        Yields the path of every file under pth; see scantree.
+    '''
+    for entry in scantree(pth, **kwargs):
+        yield entry.path
+
+
+class DeviceLimiter:
+    '''
+        Caps the filesystem calls in flight on each device (st_dev) at
+        cap, so one slow mount cannot take every thread and a fast one
+        is not flooded. hold(dev) is a context manager; a cap of None
+        means no limit.
+    '''
+
+    def __init__(self, cap=None):
+        self.cap = cap
+        self.lock = threading.Lock()
+        self.slots = {}
+
+    def hold(self, dev):
+        return self._slot(dev, self.cap)
+
+    def _slot(self, key, cap):
+        if not cap:
+            return _NOLIMIT
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.slots[key] = threading.BoundedSemaphore(cap)
+        return slot
+
+    def gate(self, task):
+        '''
+            The slot of a (path, stat, ...) task's device.
+        '''
+        st = task[1]
+        return self.hold(st.st_dev if st is not None else None)
+
+    def wrap(self, func):
+        '''
+            func(task) for (path, stat, ...) tasks, holding a slot on
+            the file's device while it runs.
+        '''
+        def limited(task):
+            with self.gate(task):
+                return func(task)
+        return limited
+
+
+class IOLanes(DeviceLimiter):
+    '''
+        One I/O lane per physical disk, shared by every crawl: files on
+        any partition of a disk are read through its lane, at most
+        rotational at a time on spinning disks, so a spindle never
+        seeks between parallel reads, and solid at a time on flash.
+        Disks are found through sysfs from st_dev; elsewhere every
+        st_dev is a lane of its own, treated as solid.
+    '''
+
+    def __init__(self, rotational=1, solid=4, sysfs='/sys'):
+        DeviceLimiter.__init__(self)
+        self.rotational, self.solid = rotational, solid
+        self.sysfs = sysfs
+        self.disks = {}
+
+    def disk(self, dev):
+        '''
+            (disk name, True if it spins) for st_dev dev.
+        '''
+        found = self.disks.get(dev)
+        if found is None:
+            found = ('dev%s' % dev, False)
+            if dev is not None:
+                devno = '%d:%d' % (os.major(dev), os.minor(dev))
+                node = os.path.join(self.sysfs, 'dev', 'block', devno)
+                if os.path.exists(node):
+                    disk = os.path.realpath(node)
+                    if os.path.exists(os.path.join(disk, 'partition')):
+                        disk = os.path.dirname(disk)
+                    spins = _readsys(os.path.join(disk, 'queue',
+                                                  'rotational')) == '1'
+                    found = (os.path.basename(disk), spins)
+            self.disks[dev] = found
+        return found
+
+    def depth(self, dev):
+        return self.rotational if self.disk(dev)[1] else self.solid
+
+    def hold(self, dev):
+        return self._slot(self.disk(dev)[0], self.depth(dev))
 
-def getfilepaths(pth):
-    return [os.path.join(dp, f) for dp, dn, fn in os.walk(pth) for f in fn]
 
+class _NoLimit(object):
+    def __enter__(self):
+        return self
 
-def checksum_md5(filename, blocksize=128 * md5.block_size):
+    def __exit__(self, *exc):
+        return False
+
+    def acquire(self):
+        return True
+
+    def release(self):
+        pass
+
+
+_NOLIMIT = _NoLimit()
+_LISTED = object()
+_DONE = object()
+
+
+def scantree_concurrent(top, walkers=32, limiter=None, maxdepth=None,
+                        prune=None, followlinks=False, skip=None,
+                        listed=None, stats=None, queuesize=10000,
+                        unchanged=None):
+    '''
+        Like gettasks over scantree, but directory listings and stat
+        calls run on walkers threads, for network and FUSE mounts where
+        every call waits out a round trip: many are kept in flight at
+        once, so throughput follows the number of walkers rather than
+        the latency. limiter, a DeviceLimiter, caps the calls per
+        device. Yields (path, stat) pairs in no particular order, at
+        most queuesize ahead of the consumer; listed(dirpath) is still
+        called only after all of a directory's files were yielded, and
+        unchanged is called from the walker threads.
+    '''
+    prune = prune or []
+    limiter = limiter or DeviceLimiter()
+    jobs = queue.Queue()
+    out = queue.Queue(queuesize)
+    lock = threading.Lock()
+    stop = threading.Event()
+    seen = set()
+    # jobs not finished yet, and per directory the files still to stat
+    # plus one for the listing itself
+    counts = {'jobs': 0}
+    remaining = {}
+
+    def emit(item):
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def submit(job):
+        with lock:
+            counts['jobs'] += 1
+        jobs.put(job)
+
+    def settle(dirpath):
+        # one more of dirpath's files (or its listing) is accounted for
+        with lock:
+            remaining[dirpath] -= 1
+            finished = not remaining[dirpath]
+            if finished:
+                del remaining[dirpath]
+        if finished:
+            emit((_LISTED, dirpath))
+
+    def listdir(dirpath, depth, dirst):
+        dev = dirst.st_dev
+        names = unchanged(dirpath, dirst) if unchanged else None
+        if names is not None:
+            for path, st in _subdirs(dirpath, names, depth, maxdepth, prune,
+                                     followlinks, seen,
+                                     lambda: limiter.hold(dev)):
+                submit(('dir', path, depth + 1, st))
+            with lock:
+                remaining[dirpath] = 1
+            settle(dirpath)
+            return
+        try:
+            with limiter.hold(dev):
+                entries = list(scandir(dirpath))
+        except OSError as error:
+            logging.info('Error scanning %s: %s' % (dirpath, error))
+            entries = []
+        files = []
+        for entry in entries:
+            if any(fnmatch(entry.name, pat) for pat in prune):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=followlinks):
+                    if maxdepth is not None and depth >= maxdepth:
+                        continue
+                    with limiter.hold(dev):
+                        st = _statdir(entry.path, followlinks)
+                    if followlinks:
+                        # guard against symlink loops
+                        with lock:
+                            if (st.st_dev, st.st_ino) in seen:
+                                continue
+                            seen.add((st.st_dev, st.st_ino))
+                    submit(('dir', entry.path, depth + 1, st))
+                elif entry.is_file():
+                    if skip is None or not skip(entry.path):
+                        files.append(entry)
+            except OSError as error:
+                logging.info('Error reading %s: %s' % (entry.path, error))
+        with lock:
+            remaining[dirpath] = len(files) + 1
+        for entry in files:
+            submit(('stat', entry, dirpath, dev))
+        settle(dirpath)
+
+    def statfile(entry, dirpath, dev):
+        started = time.time()
+        try:
+            with limiter.hold(dev):
+                st = entry.stat()
+        except OSError as error:
+            st = None
+            if stats:
+                stats.error(type(error).__name__)
+        if stats:
+            stats.time('stat', time.time() - started)
+        emit((entry.path, st))
+        settle(dirpath)
+
+    def work():
+        while not stop.is_set():
+            job = jobs.get()
+            if job is None:
+                return
+            try:
+                if job[0] == 'dir':
+                    listdir(*job[1:])
+                else:
+                    statfile(*job[1:])
+            except Exception as error:
+                logging.info('Error walking %s: %s' % (job[1], error))
+            with lock:
+                counts['jobs'] -= 1
+                done = not counts['jobs']
+            if done:
+                emit(_DONE)
+
+    try:
+        topst = os.stat(top)
+    except OSError as error:
+        logging.info('Error scanning %s: %s' % (top, error))
+        return
+    submit(('dir', top, 0, topst))
+    threads = [threading.Thread(target=work) for _ in range(walkers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            item = out.get()
+            if item is _DONE:
+                break
+            if item[0] is _LISTED:
+                if listed is not None:
+                    listed(item[1])
+            else:
+                yield item
+    finally:
+        stop.set()
+        for _ in threads:
+            jobs.put(None)
+
+
+def _advise(fd):
+    # tell the kernel we read front to back, where it can be told
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def _mapped(mm, blocksize):
+    '''
+        Yields zero-copy windows of blocksize bytes over the mmap mm.
+    '''
+    if sys.version_info[0] < 3:
+        for offset in range(0, len(mm), blocksize):
+            yield buffer(mm, offset, blocksize)
+        return
+    if hasattr(mm, 'madvise'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    with memoryview(mm) as view:
+        for offset in range(0, len(view), blocksize):
+            with view[offset:offset + blocksize] as window:
+                yield window
+
+
+def readchunks(f, size, blocksize=BLOCKSIZE):
+    '''
+        Yields the contents of the unbuffered binary file f, choosing a
+        read strategy by its size: a single read for small files, mmap
+        for large ones and a reused per-thread bytearray filled with
+        readinto otherwise. A chunk is only valid until the next one is
+        requested.
+    '''
+    if size <= SMALLFILE:
+        # normally one read, plus the one that finds end of file
+        for chunk in iter(lambda: f.read(SMALLFILE), b''):
+            yield chunk
+        return
+    _advise(f.fileno())
+    if size >= MMAPFILE:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            # e.g. a FUSE mount without mmap support
+            mm = None
+        if mm is not None:
+            try:
+                for chunk in _mapped(mm, blocksize):
+                    yield chunk
+            finally:
+                mm.close()
+            return
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) != blocksize:
+        buf = _buffers.buf = bytearray(blocksize)
+    view = memoryview(buf)
+    while True:
+        count = f.readinto(buf)
+        if not count:
+            break
+        yield view[:count]
+
+
+def hashfile(filename, hashes=('md5',), blocksize=BLOCKSIZE, size=None,
+             headsize=0):
+    '''
+        Get digests of file for every algorithm in hashes, feeding each
+        hasher from the same chunk in a single read of the file. size
+        picks the read strategy, see readchunks; it is looked up when
+        not given. Returns ({algorithm: hexdigest}, head) where head
+        holds the first headsize bytes, kept for file type detection.
+    '''
+    hashers = [hashlib.new(name) for name in hashes]
+    head = bytearray()
+    with open(filename, 'rb', 0) as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        for chunk in readchunks(f, size, blocksize):
+            if len(head) < headsize:
+                head += chunk[:headsize - len(head)]
+            for hasher in hashers:
+                hasher.update(chunk)
+    digests = dict(zip(hashes, [hasher.hexdigest() for hasher in hashers]))
+    return digests, bytes(head)
+
+
+def checksum(filename, hashes=('md5',), blocksize=BLOCKSIZE, size=None):
+    '''
+        Get digests of file, see hashfile. Returns {algorithm: hexdigest}.
+    '''
+    return hashfile(filename, hashes, blocksize, size)[0]
+
+
+def checksum_md5(filename, blocksize=BLOCKSIZE):
     '''
         Get md5 digest of file
     '''
-    md5 = hashlib.md5()
-    with open(filename, 'rb') as f:
-        for chunk in iter(lambda: f.read(blocksize), b''):
-            md5.update(chunk)
-    return md5.hexdigest()
+    return checksum(filename, ['md5'], blocksize)['md5']
 
 
-def getmetadata(path):
+def samplefile(filename, size=None, blocksize=SAMPLEBLOCK, headsize=0):
+    '''
+        Cheap fingerprint of a large file for triage crawls: md5 of its
+        size and of blocksize bytes at the head, at each of
+        SAMPLEPOINTS through the file and at the tail. Equal files get
+        equal samples but not the other way round, so the digest still
+        comes from the full pass. Returns (hexdigest, head) like
+        hashfile.
     '''
-        captures metadata of path received.
+    with open(filename, 'rb', 0) as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        hasher = hashlib.md5(('%d' % size).encode('ascii'))
+        head = f.read(max(blocksize, headsize))
+        hasher.update(head[:blocksize])
+        for offset in [int(size * point) for point in SAMPLEPOINTS] + \
+                [size - blocksize]:
+            f.seek(offset)
+            hasher.update(f.read(blocksize))
+    return hasher.hexdigest(), head[:headsize]
+
+
+def getfiletype(path, head, size, trustext=()):
+    '''
+        MIME type of path, sniffed from head, the leading bytes already
+        read by the hasher, so the file is not opened a second time.
+        Paths whose extension is in trustext are typed from the
+        extension alone.
+    '''
+    if trustext:
+        ext = os.path.splitext(path)[1].lower()
+        if ext in trustext and ext in mimetypes.types_map:
+            return mimetypes.types_map[ext]
+    key = (size, hashlib.md5(head).digest())
+    found = _TYPECACHE.get(key)
+    if found is None:
+        detector = getattr(_magic, 'handle', None)
+        if detector is None:
+            detector = _magic.handle = magic.Magic(mime=True)
+        found = detector.from_buffer(head)
+        if len(_TYPECACHE) >= TYPECACHESIZE:
+            _TYPECACHE.clear()
+        _TYPECACHE[key] = found
+    return found
+
+
+def getfields(hashes):
+    '''
+        Output columns for a crawl computing hashes: digest carries the
+        first algorithm, the rest are appended under their own names.
+    '''
+    return KEYS + list(hashes[1:])
+
+
+def getdigests(metadata, hashes):
+    '''
+        Inverse of getfields: {algorithm: hexdigest} from a record.
+    '''
+    digests = dict((name, getattr(metadata, name)) for name in hashes[1:])
+    digests[hashes[0]] = metadata.digest
+    return digests
+
+
+def getmetadata(path, meta=None, known=None, hashes=('md5',),
+                blocksize=BLOCKSIZE, sniffsize=SNIFFSIZE, trustext=(),
+                timings=None, triage=False):
+    '''
+        captures metadata of path received, with timestamps as integer
+        nanoseconds. meta is an optional stat result already fetched by
+        the walker, saving a second os.stat.
+        known is a cached (filetype, digests) pair that skips both the
+        libmagic call and hashing. hashes lists the digest algorithms,
+        see getfields; sniffsize and trustext tune getfiletype. A
+        timings dict, if given, gets the seconds spent reading and
+        hashing, in libmagic, the bytes read and the type of any error.
+        With triage set, files over SAMPLEFULL bytes only get a sample
+        (see samplefile) and no digest.
     '''
     try:
-        metadata = OrderedDict()
-        meta = os.stat(path)
-        (mde, ino, dev, nlink, uid, gid, size, atime, mtime, ctime) = meta
+        if meta is None:
+            meta = os.stat(path)
         # file size in bytes
-        metadata['path'] = path
-        metadata['filesize'] = size
-        for timestamp in ['atime', 'mtime', 'ctime']:
-            metadata[timestamp] = time.asctime(time.localtime(eval(timestamp)))
-        metadata['filetype'] = magic.from_file(path, mime=True)
-        metadata['digest'] = checksum_md5(path)
+        size = meta.st_size
+        metadata = Record(path, size, _time_ns(meta, 'atime'),
+                          _time_ns(meta, 'mtime'), _time_ns(meta, 'ctime'))
+        if known:
+            metadata.filetype, digests = known
+        else:
+            started = time.time()
+            if triage and size > SAMPLEFULL:
+                digests = {}
+                metadata.sample, head = samplefile(path, size,
+                                                   headsize=sniffsize)
+                nbytes = SAMPLEFULL
+            else:
+                digests, head = hashfile(path, hashes, blocksize, size,
+                                         sniffsize)
+                nbytes = size
+            hashed = time.time()
+            metadata.filetype = getfiletype(path, head, size, trustext)
+            if timings is not None:
+                timings['hash'] = hashed - started
+                timings['magic'] = time.time() - hashed
+                timings['bytes'] = nbytes
+        metadata.digest = digests.get(hashes[0])
+        for name in hashes[1:]:
+            setattr(metadata, name, digests.get(name))
         return metadata
     except Exception, error:
         logging.info('Error capturing metadata for %s' % path)
         logging.info('Error is %s' % error)
+        if timings is not None:
+            timings['error'] = type(error).__name__
+
+
+def _metadata_task(task, **kwargs):
+    '''
+        Pool worker: task is a (path, stat, known, profile) tuple from
+        the walker, kwargs are passed on to getmetadata. Returns the
+        path, stat, record and the timings getmetadata measured; with
+        profile set the call runs under cProfile and its raw stats are
+        added to the timings.
+    '''
+    path, st, known, profile = task
+    timings = {}
+    if profile:
+        profiler = cProfile.Profile()
+        meta = profiler.runcall(getmetadata, path, st, known,
+                                timings=timings, **kwargs)
+        profiler.create_stats()
+        timings['profile'] = profiler.stats
+    else:
+        meta = getmetadata(path, st, known, timings=timings, **kwargs)
+    return path, st, meta, timings
+
+
+class _StatCopy(object):
+    '''
+        Picklable copy of every st_* field of a stat, st_*_ns included,
+        which a Python 2 os.stat_result has no room for.
+    '''
+
+    def __init__(self, st):
+        for name in dir(st):
+            if name.startswith('st_'):
+                setattr(self, name, getattr(st, name))
+
+
+def _portable_stat(st):
+    '''
+        The Python 2 scandir backport has its own stat_result type that
+        cannot be pickled; copy it for process pools, keeping the whole
+        nanoseconds the digest cache is keyed on.
+    '''
+    if st is None or isinstance(st, os.stat_result):
+        return st
+    return _StatCopy(st)
+
+
+def _bounded(iterable, slots, stop):
+    '''
+        Hands items to the pool only while a slot is free, so the walker
+        never runs more than the queue size ahead of the writer.
+    '''
+    for item in iterable:
+        slots.acquire()
+        if stop.is_set():
+            return
+        yield item
+
+
+def _imap_shared(func, iterable, pool, ordered, queuesize, gate=None):
+    '''
+        imap_bounded over a pool shared with other callers. The pool's
+        imap has one task-feeding thread for everyone, which drains one
+        caller's (blocking, lazy) iterable before it starts on the
+        next, so a slow walk would hold up every other crawl. Instead
+        each call feeds the pool from a thread of its own with
+        apply_async. gate(item), if given, is a semaphore taken before
+        the item is handed to the pool and released once it is done,
+        so an item waiting for it waits here, not on a pool thread.
+    '''
+    slots = threading.Semaphore(queuesize)
+    stop = threading.Event()
+    results = queue.Queue()
+
+    def call(item, slot):
+        try:
+            return True, func(item)
+        except Exception as error:
+            return False, error
+        finally:
+            slot.release()
+
+    def feed():
+        count = 0
+        try:
+            for item in iterable:
+                slots.acquire()
+                if stop.is_set():
+                    break
+                slot = gate(item) if gate else _NOLIMIT
+                slot.acquire()
+                if stop.is_set():
+                    slot.release()
+                    break
+                if ordered:
+                    results.put(pool.apply_async(call, (item, slot)))
+                else:
+                    pool.apply_async(call, (item, slot),
+                                     callback=results.put)
+                count += 1
+        except Exception as error:
+            results.put((_DONE, count, error))
+            return
+        results.put((_DONE, count, None))
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    received, total = 0, None
+    try:
+        while total is None or received < total:
+            item = results.get()
+            if isinstance(item, tuple) and item[0] is _DONE:
+                total, error = item[1:]
+                if error is not None:
+                    raise error
+                continue
+            ok, value = item.get() if ordered else item
+            received += 1
+            slots.release()
+            if not ok:
+                raise value
+            yield value
+    finally:
+        # unblock the feeder if we are bailing out early
+        stop.set()
+        for _ in range(queuesize):
+            slots.release()
+
+
+def imap_bounded(func, iterable, workers, processes=False, ordered=True,
+                 queuesize=None, pool=None, gate=None):
+    '''
+        Maps func over iterable on a thread (or process) pool, yielding
+        results in input order, or in completion order when ordered is
+        False. At most queuesize items are in flight at any time, which
+        keeps memory bounded however long the iterable is. An existing
+        pool, shared with other callers, is used if given and left
+        running, and gate then admits items to it, see _imap_shared.
+    '''
+    queuesize = queuesize or workers * 4 or multiprocessing.cpu_count() * 4
+    if pool is not None:
+        for result in _imap_shared(func, iterable, pool, ordered, queuesize,
+                                   gate):
+            yield result
+        return
+    slots = threading.Semaphore(queuesize)
+    stop = threading.Event()
+    owned = pool is None
+    if owned:
+        pool = multiprocessing.Pool(workers) if processes \
+            else ThreadPool(workers)
+    mapper = pool.imap if ordered else pool.imap_unordered
+    try:
+        for result in mapper(func, _bounded(iterable, slots, stop)):
+            slots.release()
+            yield result
+        if owned:
+            pool.close()
+    finally:
+        # unblock the feeder if we are bailing out early
+        stop.set()
+        for _ in range(queuesize):
+            slots.release()
+        if owned:
+            pool.terminate()
+            pool.join()
 
 
 def run(cmd):
@@ -139,16 +2492,188 @@ def get_mounts_osx():
     return alldetails
 
 
-def getmounstonlinux():
+def _unescape(name):
+    # mountinfo escapes blanks and backslashes as octal, udev labels as \xNN
+    name = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), name)
+    return re.sub(r'\\x([0-9a-fA-F]{2})', lambda m: chr(int(m.group(1), 16)),
+                  name)
+
+
+def parse_mountinfo(text):
+    '''
+        Parses the contents of /proc/<pid>/mountinfo into a list of
+        dicts with devno ("major:minor"), root, mount_point, fstype
+        and source.
+    '''
+    mounts = []
+    for line in text.splitlines():
+        fields = line.split()
+        if '-' not in fields:
+            continue
+        sep = fields.index('-')
+        mounts.append({'devno': fields[2],
+                       'root': _unescape(fields[3]),
+                       'mount_point': _unescape(fields[4]),
+                       'fstype': fields[sep + 1],
+                       'source': _unescape(fields[sep + 2])})
+    return mounts
+
+
+def _readsys(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return ''
+
+
+class MountWatcher:
+    '''
+        Finds removable mounts on Linux from mountinfo, sysfs and the
+        udev /dev/disk/by-uuid and by-label links, without shelling
+        out. The kernel flags mountinfo with POLLPRI whenever the mount
+        table changes, so wait() sleeps in poll() rather than
+        re-scanning, and changes() reports only what was mounted since
+        the previous call, in the same shape as get_mounts_osx. The
+        paths can point at fixture files and trees.
+    '''
+
+    def __init__(self, mountinfo='/proc/self/mountinfo', sysfs='/sys',
+                 devdir='/dev'):
+        self.mountinfo, self.devdir = mountinfo, devdir
+        self.sysfs = os.path.realpath(sysfs)
+        self.known = set()
+        self.disks = {}
+        self.poller = None
+        self.handle = open(mountinfo)
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+            self.poller.register(self.handle, select.POLLPRI | select.POLLERR)
+
+    def wait(self, timeout=None):
+        '''
+            Blocks until the mount table changes or timeout seconds
+            pass; True if it changed.
+        '''
+        if self.poller is None:
+            time.sleep(timeout or 0)
+            return True
+        return bool(self.poller.poll(None if timeout is None
+                                     else timeout * 1000))
+
+    def _links(self, kind):
+        # partition name (e.g. sdb1) -> uuid or label
+        links = {}
+        linkdir = os.path.join(self.devdir, 'disk', kind)
+        try:
+            names = os.listdir(linkdir)
+        except OSError:
+            return links
+        for name in names:
+            target = os.path.realpath(os.path.join(linkdir, name))
+            links[os.path.basename(target)] = _unescape(name)
+        return links
+
+    def _disk(self, devno):
+        '''
+            sysfs facts about the disk holding block device devno, or
+            None if it is not a removable or USB block device.
+        '''
+        if devno in self.disks:
+            return self.disks[devno]
+        info = None
+        node = os.path.join(self.sysfs, 'dev', 'block', devno)
+        if os.path.exists(node):
+            real = os.path.realpath(node)
+            part = os.path.basename(real)
+            disk = real
+            if os.path.exists(os.path.join(real, 'partition')):
+                disk = os.path.dirname(real)
+            removable = _readsys(os.path.join(disk, 'removable')) == '1'
+            usb = None
+            parent = disk
+            while parent.startswith(self.sysfs) and parent != self.sysfs:
+                if os.path.exists(os.path.join(parent, 'idVendor')):
+                    usb = parent
+                    break
+                parent = os.path.dirname(parent)
+            if removable or usb:
+                device = os.path.join(disk, 'device')
+                info = {'disk': os.path.basename(disk), 'part': part,
+                        '_name': _readsys(os.path.join(device, 'model')),
+                        'manufacturer': _readsys(os.path.join(device,
+                                                              'vendor')),
+                        'vendor_id': usb and _readsys(os.path.join(
+                            usb, 'idVendor')),
+                        'product_id': usb and _readsys(os.path.join(
+                            usb, 'idProduct'))}
+        self.disks[devno] = info
+        return info
+
+    def snapshot(self):
+        '''
+            Returns (key, disk info, mount) for every removable mount.
+        '''
+        self.handle.seek(0)
+        found = []
+        mounted = set()
+        for mount in parse_mountinfo(self.handle.read()):
+            mounted.add(mount['devno'])
+            info = self._disk(mount['devno'])
+            if info:
+                found.append(((mount['devno'], mount['mount_point']),
+                              info, mount))
+        # major:minor numbers are reused by the next device plugged in
+        for devno in set(self.disks) - mounted:
+            del self.disks[devno]
+        return found
+
+    def changes(self):
+        '''
+            Removable mounts added since the last call (all of them on
+            the first), grouped per disk like get_mounts_osx.
+        '''
+        current = self.snapshot()
+        new = [item for item in current if item[0] not in self.known]
+        self.known = set(item[0] for item in current)
+        if not new:
+            return []
+        uuids, labels = self._links('by-uuid'), self._links('by-label')
+        devices = OrderedDict()
+        for key, info, mount in new:
+            if info['disk'] not in devices:
+                temp = {'mount_point': [],
+                        'volume_name': [],
+                        'volume_uuid': []}
+                for param in ['_name', 'manufacturer',
+                              'product_id', 'vendor_id']:
+                    temp[param] = info[param]
+                devices[info['disk']] = temp
+            temp = devices[info['disk']]
+            temp['mount_point'].append(mount['mount_point'])
+            temp['volume_name'].append(
+                labels.get(info['part']) or
+                os.path.basename(mount['mount_point']))
+            temp['volume_uuid'].append(uuids.get(info['part'], ''))
+        return list(devices.values())
+
+
+MOUNTWATCHER = None
+
+
+def getmounstonlinux(timeout=5):
     '''
-        get mounts on Linux
+        get mounts on Linux: removable mounts that appeared since the
+        last call. The first call returns every removable mount; later
+        calls wait up to timeout seconds for the mount table to change,
+        since a USB device is announced before it is mounted.
     '''
-    # TODO
-    # 1. Parse OS utility
-    #   a. for each USB device get `Mount Point`, manufacturer, vendor
-    # 2. if DEVICES is empty, save them in global variable DEVICEs
-    # 3. If new mount points appear, return [ [mp, vendor, prod, manuftr]]
-    pass
+    global MOUNTWATCHER
+    if MOUNTWATCHER is None:
+        MOUNTWATCHER = MountWatcher()
+    else:
+        MOUNTWATCHER.wait(timeout)
+    return MOUNTWATCHER.changes()
 
 
 def get_new_devices():
@@ -159,56 +2684,768 @@ def get_new_devices():
     osname = platform.system()
     if osname == 'Darwin':
         return get_mounts_osx()
-    elif osname is 'Linux':
-        # TODO : find new USB devices on linux
+    elif osname == 'Linux':
         return getmounstonlinux()
     else:
         print "Not implemented for :", osname
         return []
 
 
-def hotplug_callback(context, device, event):
+class CrawlScheduler:
     '''
-        libbusb call-back when device arrives / leaves.
-        On arrival, we crawl it.
+        Runs USB-mode crawls away from the libusb event loop. The
+        hotplug callback only queues events; this thread waits until no
+        event has come in for debounce seconds, looks for new mounts
+        and crawls each new volume on its own thread, so several
+        devices are crawled at once. When a device leaves, the crawls
+        whose mount point is gone are cancelled.
     '''
-    if libusb1.LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED:
+
+    def __init__(self, debounce=1.0):
+        self.debounce = debounce
+        self.events = queue.Queue()
+        self.crawls = {}  # mount point -> (thread, cancel event)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def notify(self, event):
+        '''
+            Queues a libusb hotplug event; never blocks.
+        '''
+        self.events.put(event)
+
+    def _run(self):
+        running = True
+        while running:
+            pending = [self.events.get()]
+            # debounce: a device arriving often fires several events
+            while True:
+                try:
+                    pending.append(self.events.get(timeout=self.debounce))
+                except queue.Empty:
+                    break
+            running = None not in pending
+            # one bad pass must not end the scheduler thread
+            try:
+                if libusb1.LIBUSB_HOTPLUG_EVENT_DEVICE_LEFT in pending:
+                    self._reap()
+            except Exception as error:
+                logging.error("Reaping finished crawls failed: %s" % error)
+            try:
+                if running and (libusb1.LIBUSB_HOTPLUG_EVENT_DEVICE_ARRIVED
+                                in pending):
+                    self._arrived()
+            except Exception as error:
+                logging.error("Handling new devices failed: %s" % error)
+
+    def _arrived(self):
         usbdrives = get_new_devices()
-        if usbdrives:
-            for dev in usbdrives:
-                for mnt, vol, uuid in zip(dev['mount_point'],
-                                          dev['volume_name'],
-                                          dev['volume_uuid']):
-                    key = md5("%s-%s-%s" % (mnt, vol, uuid)).hexdigest()
-                    created_on = os.stat(mnt).st_ctime
-                    if CACHE.get(key) < created_on:
-                        CACHE[key] = time.time()
-                        if mnt:
-                            filename = vol + " " + time.ctime(time.time())
-                            write_data(filename + '.csv', mnt)
-                    else:
-                        print "IGNORING cached device: ", vol
-                        logging.info("CACHED : %s" % mnt)
-    else:
-        print "Device left: ", device
+        for dev in usbdrives or []:
+            for mnt, vol, uuid in zip(dev['mount_point'],
+                                      dev['volume_name'],
+                                      dev['volume_uuid']):
+                if not mnt:
+                    continue
+                key = DeviceRegistry.key(mnt, vol, uuid)
+                try:
+                    fingerprint = DeviceRegistry.fingerprint(mnt)
+                except OSError as error:
+                    logging.info("Cannot read %s: %s" % (mnt, error))
+                    continue
+                action = REGISTRY.check(key, fingerprint)
+                if CRAWLOPTS.get('full'):
+                    action = 'full'
+                if action == 'skip':
+                    print "IGNORING unchanged device: ", vol
+                    logging.info("UNCHANGED : %s" % mnt)
+                else:
+                    logging.info("%s crawl of %s" % (action, mnt))
+                    self._start(mnt, vol, (key, uuid, fingerprint),
+                                action == 'full')
+
+    def _start(self, mnt, vol, device, full):
+        with self.lock:
+            if mnt in self.crawls:
+                return
+            cancel = threading.Event()
+            thread = threading.Thread(target=self._crawl,
+                                      args=(mnt, vol, device, full, cancel))
+            self.crawls[mnt] = (thread, cancel)
+        thread.start()
+
+    def _crawl(self, mnt, vol, device, full, cancel):
+        key, uuid, fingerprint = device
+        try:
+            filename = vol + " " + time.ctime(time.time())
+            # device and inode numbers change with every insertion
+            options = dict(CRAWLOPTS, full=full, cancel=cancel,
+                           cachevolume=key)
+            output = DBFILE or filename + SUFFIXES[CRAWLOPTS['fmt']]
+            files = write_data(output, mnt, **options)
+            if not cancel.is_set():
+                REGISTRY.record(key, uuid, vol, mnt, fingerprint, files, full)
+                if INDEXFILE:
+                    search.update(INDEXFILE, [output])
+        except Exception as error:
+            logging.info("Crawl of %s failed: %s" % (mnt, error))
+        finally:
+            with self.lock:
+                del self.crawls[mnt]
+
+    def _reap(self):
+        with self.lock:
+            crawls = list(self.crawls.items())
+        for mnt, (thread, cancel) in crawls:
+            if not os.path.ismount(mnt):
+                print "Device left: ", mnt
+                logging.info("Cancelling crawl of %s" % mnt)
+                cancel.set()
+
+    def stop(self):
+        '''
+            Cancels running crawls and waits for their output to flush.
+        '''
+        self.events.put(None)
+        self.thread.join()
+        with self.lock:
+            crawls = list(self.crawls.values())
+        for thread, cancel in crawls:
+            cancel.set()
+            thread.join()
+
+
+SCHEDULER = None
+
+
+def hotplug_callback(context, device, event):
+    '''
+        libbusb call-back when device arrives / leaves. Only hands the
+        event to SCHEDULER, so the libusb event loop is never held up
+        by mount detection or a crawl.
+    '''
+    SCHEDULER.notify(event)
+
+
+# FS_IOC_FIEMAP and the sizes of struct fiemap and one fiemap_extent
+FIEMAP = 0xC020660B
+FIEMAPHEAD = struct.Struct('=QQIIII')
+FIEMAPEXTENT = 56
 
 
-def write_data(fname, source):
+def physical_offset(path):
     '''
-        Writes metadata for each file to a specific csv file
+        Where on the device the first extent of path starts, from the
+        FIEMAP ioctl, or None where that is not supported (other
+        systems, filesystems without extents, files stored inline).
     '''
+    if fcntl is None:
+        return None
+    request = array.array('B', FIEMAPHEAD.pack(0, (1 << 64) - 1, 0, 0, 1, 0)
+                          + b'\0' * FIEMAPEXTENT)
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FIEMAP, request, True)
+    except (IOError, OSError):
+        return None
+    finally:
+        os.close(fd)
+    data = request.tostring() if not hasattr(request, 'tobytes') \
+        else request.tobytes()
+    mapped = FIEMAPHEAD.unpack_from(data)[3]
+    if not mapped:
+        return None
+    # fe_physical follows fe_logical in the first extent
+    return struct.unpack_from('=Q', data, FIEMAPHEAD.size + 8)[0]
+
+
+def readorder(tasks, window=10000, by='inode'):
+    '''
+        Reorders (path, stat, known) tasks so files are read in the
+        order they sit on disk, cutting seeks on spinning and cheap
+        flash media: up to window tasks are gathered, then released
+        sorted by inode number, or with by='extent' by the physical
+        offset of their first extent (falling back to the inode where
+        FIEMAP cannot tell). Tasks whose digests are already known need
+        no reading and go straight through.
+    '''
+    pending = []
+
+    def key(task):
+        path, st, known = task
+        if st is None:
+            return (0, 0, 0)
+        if by == 'extent':
+            offset = physical_offset(path)
+            if offset is not None:
+                return (st.st_dev, 0, offset)
+        return (st.st_dev, 1, st.st_ino)
+
+    def drain():
+        pending.sort()
+        for item in pending:
+            yield item[-1]
+        del pending[:]
+
+    for num, task in enumerate(tasks):
+        if task[2]:
+            yield task
+            continue
+        # num keeps the sort stable and never compares the tasks
+        pending.append((key(task), num, task))
+        if len(pending) >= window:
+            for item in drain():
+                yield item
+    for item in drain():
+        yield item
+
+
+def gettasks(source, followlinks=False, stats=None, walkers=0,
+             limiter=None, **kwargs):
+    '''
+        Yields (path, stat) pairs for the files under source, reusing
+        the stat result cached on each DirEntry. The time each stat
+        takes is reported to stats, a CrawlStats, if given. With walkers
+        set, the tree is listed and stat'ed concurrently, see
+        scantree_concurrent.
+    '''
+    if walkers:
+        for task in scantree_concurrent(source, walkers, limiter,
+                                        followlinks=followlinks,
+                                        stats=stats, **kwargs):
+            yield task
+        return
+    for entry in scantree(source, followlinks=followlinks, **kwargs):
+        started = time.time()
+        try:
+            st = entry.stat()
+        except OSError as error:
+            st = None
+            if stats:
+                stats.error(type(error).__name__)
+        if stats:
+            stats.time('stat', time.time() - started)
+        yield entry.path, st
+
+
+def write_data(fname, source, fmt='csv', maxdepth=None, prune=None,
+               followlinks=False, workers=0, processes=False, ordered=True,
+               queuesize=None, cachefile=None, full=False, cachemaxage=None,
+               writeropts=None, background=False, hashes=('md5',),
+               blocksize=BLOCKSIZE, sniffsize=SNIFFSIZE, trustext=(),
+               hashsets=None, cancel=None, checkpoint=None, resume=False,
+               checkpointinterval=60.0, progress=False, statsfile=None,
+               statsinterval=10.0, profileevery=0, profilefile=None,
+               walkers=0, permount=None, pool=None, lanes=None,
+               order=None, orderwindow=10000, triage=False,
+               rollupfile=None, skipunchanged=False, cachevolume=None):
+    '''
+        Writes metadata for each file to fname using the fmt backend
+        from WRITERS, configured by writeropts; with background set the
+        writer runs on its own thread. With workers set, hashing and
+        type detection run on a pool while this thread remains the
+        single writer. With cachefile set, unchanged files reuse the
+        digests from a previous crawl; cachevolume keys them on that
+        volume and the path below source instead of device and inode,
+        see DigestCache. hashes picks the digest
+        algorithms, all computed in one pass of blocksize reads, and the
+        first sniffsize bytes of that pass give the file type. Rows
+        are tagged with their match against any of hashsets. Setting
+        the cancel event stops the crawl after the current file.
+        With checkpoint set, progress is saved to that state file every
+        checkpointinterval seconds and on interruption; resume picks a
+        crawl of the same source up from there, in its original output.
+        Per-stage timings are kept in a CrawlStats: progress shows them
+        on a live line and statsfile gets them as JSON every
+        statsinterval seconds. With profileevery set, one file in that
+        many is processed under cProfile and the combined profile is
+        saved to profilefile. For high-latency mounts, walkers lists
+        and stats the tree on that many threads, and permount caps the
+        listing, stat and (in thread pools) read calls in flight per
+        device. pool is a thread pool shared with other crawls, used
+        instead of one of workers threads, and lanes an IOLanes that
+        every file read goes through. order ('inode' or 'extent')
+        reads files in on-disk order within windows of orderwindow
+        files, see readorder. With triage set, large files first only
+        get a sample fingerprint, so the whole output is there quickly;
+        once it is closed a niced child interpreter hashes them in full and
+        fills in their digests, see fullpass. With rollupfile set, the
+        crawl and its directory rollups are recorded in that
+        RollupStore; skipunchanged then carries unchanged directories
+        over from the last crawl of source instead of listing them.
+        Returns the number of files written.
+    '''
+    state = Checkpoint(checkpoint, checkpointinterval) if checkpoint else None
+    writeropts = dict(writeropts or {})
+    if state and resume and os.path.exists(checkpoint):
+        saved = state.load()
+        if saved.get('source') == source:
+            fname, fmt = saved['output'], saved['fmt']
+            writeropts['resume'] = saved['position']
+            logging.info("Resuming crawl of %s from %s" % (source, checkpoint))
+        else:
+            logging.info("Checkpoint %s is for %s, starting afresh" %
+                         (checkpoint, saved.get('source')))
+            state = Checkpoint(checkpoint, checkpointinterval)
     mesg = "Crawling {:s}. Saving it to: {:s}".format(source, fname)
     print mesg
     logging.info(mesg)
-    allpaths = getfilepaths(source)
-    capturedata = CSVWriter(fname)
-    for path in allpaths:
-        meta = getmetadata(path)
-        if meta:
-            capturedata.writerow(meta)
+    fields = getfields(hashes)
+    if hashsets:
+        fields = fields + ['match', 'hashset']
+    if triage:
+        fields = fields + ['sample']
+    capturedata = WRITERS[fmt](fname, source, fields, **writeropts)
+    crawl = getattr(capturedata, 'crawl', None)
+    deferred = []
+    if background:
+        capturedata = BackgroundWriter(capturedata)
+    stats = CrawlStats(source)
+    limiter = DeviceLimiter(permount)
+    walk = dict(maxdepth=maxdepth, prune=prune, followlinks=followlinks,
+                stats=stats, walkers=walkers, limiter=limiter)
+    rollups = RollupStore(rollupfile) if rollupfile else None
+    if rollups:
+        rollups.begin(source, skipunchanged, json.dumps(dict(
+            hashes=list(hashes), prune=sorted(prune or ()),
+            maxdepth=maxdepth, followlinks=followlinks,
+            trustext=sorted(trustext),
+            hashsets=sorted(hs.name for hs in hashsets or ())),
+            sort_keys=True))
+        walk['unchanged'] = rollups.unchanged
+    if state:
+        state.start(source, fname, fmt)
+        tasks = state.track(gettasks(source, skip=state.isdone,
+                                     listed=state.listed, **walk))
+    else:
+        tasks = gettasks(source, **walk)
+    cache = DigestCache(cachefile, full=full, volume=cachevolume,
+                        root=source) if cachefile else None
+    if cache:
+        tasks = ((path, st, cache.get(st, hashes, path))
+                 for path, st in tasks)
+    else:
+        tasks = ((path, st, None) for path, st in tasks)
+    if order:
+        tasks = readorder(tasks, orderwindow, order)
+    if processes:
+        tasks = ((path, _portable_stat(st), known)
+                 for path, st, known in tasks)
+    # flag a sample of the files for profiling
+    tasks = ((path, st, known, profileevery and num % profileevery == 0)
+             for num, (path, st, known) in enumerate(tasks))
+    capture = functools.partial(_metadata_task, hashes=hashes,
+                                blocksize=blocksize, sniffsize=sniffsize,
+                                trustext=trustext, triage=triage)
+    if permount and not processes:
+        capture = limiter.wrap(capture)
+    gate = None
+    if lanes and pool:
+        # a file waits for its lane before it takes a shared pool
+        # thread, which stays free for other devices meanwhile
+        gate = lanes.gate
+    elif lanes and not processes:
+        capture = lanes.wrap(capture)
+    if workers or pool:
+        results = imap_bounded(capture, tasks, workers,
+                               processes=processes, ordered=ordered,
+                               queuesize=queuesize, pool=pool, gate=gate)
+    else:
+        results = (capture(task) for task in tasks)
+    written = 0
+    finished = False
+    stats.start(progress, statsfile, statsinterval if statsfile else 1.0)
+    try:
+        for path, st, meta, timings in results:
+            stats.add(timings)
+            if cancel is not None and cancel.is_set():
+                logging.info("Crawl of %s cancelled" % source)
+                break
+            if meta:
+                if meta.digest is None:
+                    # sampled by triage, hashed in the full pass
+                    deferred.append((path, st, meta.filetype))
+                elif hashsets:
+                    meta.match, meta.hashset = matchhashsets(
+                        getdigests(meta, hashes), hashsets)
+                started = time.time()
+                capturedata.writerow(meta)
+                stats.wrote(time.time() - started)
+                written += 1
+                if rollups:
+                    rollups.add(meta)
+                if cache and meta.digest is not None:
+                    cache.put(st, meta.filetype, getdigests(meta, hashes),
+                              path)
+            else:
+                logging.info("Found no meta for path : %s" % path)
+            if state:
+                state.written(path)
+                if state.due():
+                    state.save(capturedata.position())
         else:
-            logging.info("Found no meta for path : %s" % path)
-    capturedata.close()
+            if rollups:
+                carried = 0
+                for record in rollups.carriedover():
+                    capturedata.writerow(record)
+                    carried += 1
+                written += carried
+                logging.info("%s: carried %d files over from unchanged "
+                             "directories" % (source, carried))
+            finished = True
+    finally:
+        # rows buffered so far still reach disk if we are interrupted
+        results.close()
+        if state and not finished:
+            # a failed save must not keep the writer from flushing
+            try:
+                state.save(capturedata.position())
+            except (EnvironmentError, ValueError) as error:
+                logging.error("Checkpoint %s not saved: %s" %
+                              (checkpoint, error))
+        capturedata.close()
+        if capturedata.errors:
+            stats.errors['write'] = capturedata.errors
+        if cache:
+            if cachemaxage is not None:
+                cache.compact(cachemaxage)
+            cache.close()
+        if rollups:
+            if finished:
+                logging.info("Rollup of %s in crawl %d: %s" % (
+                    source, rollups.crawl, rollups.finish(written)))
+            rollups.close()
+        stats.stop(progress, statsfile)
+        logging.info(stats.line())
+        if profilefile and stats.profile:
+            stats.profile.dump_stats(profilefile)
+    if state and finished:
+        state.finish()
+    if deferred and finished:
+        logging.info("Triage of %s written, hashing %d files in full" %
+                     (source, len(deferred)))
+        if lanes:
+            # the child has a lane of its own for this disk
+            try:
+                workers = lanes.depth(os.stat(source).st_dev)
+            except OSError:
+                pass
+        code = _spawnfullpass(fname, fmt, crawl, deferred, dict(
+            hashes=hashes, blocksize=blocksize, workers=workers,
+            hashsets=hashsets, cachefile=cachefile,
+            cachevolume=cachevolume, source=source))
+        if code:
+            logging.error("Full pass of %s failed with exit code %s, "
+                          "large files keep an empty digest" %
+                          (fname, code))
+    return written
+
+
+def fanout(jobs, workers=0, lanes=None, **options):
+    '''
+        Crawls several devices at once: each (fname, source) job runs
+        write_data on its own thread, with one hashing pool of workers
+        threads (default: one per CPU) shared by all of them and every
+        read going through the device's lane in lanes, an IOLanes. A
+        slow disk then only holds up its own lane while the others run
+        at full speed. Returns {source: files written}.
+    '''
+    pool = ThreadPool(workers or multiprocessing.cpu_count())
+    lanes = lanes or IOLanes()
+    options.pop('processes', None)
+    written = {}
+
+    def crawl(fname, source):
+        try:
+            written[source] = write_data(fname, source, pool=pool,
+                                         lanes=lanes, **options)
+        except Exception as error:
+            logging.info("Crawl of %s failed: %s" % (source, error))
+
+    threads = [threading.Thread(target=crawl, args=job) for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+    pool.join()
+    return written
+
+
+def _deferred_task(task, hashes=('md5',), blocksize=BLOCKSIZE):
+    path, st, filetype = task
+    try:
+        now = os.stat(path)
+        # st came from the walker, which may have whole nanoseconds
+        # where a Python 2 os.stat only has a float
+        if now.st_size != st.st_size or \
+                abs(_time_ns(now) - _time_ns(st)) > 1000:
+            logging.info('%s changed since triage, not hashed' % path)
+            return path, st, filetype, None
+        # the walker's stat is the one the cache is looked up with
+        return path, st, filetype, hashfile(path, hashes, blocksize,
+                                            st.st_size)[0]
+    except EnvironmentError as error:
+        logging.info('Error hashing %s: %s' % (path, error))
+        return path, None, filetype, None
+
+
+def fullpass(fname, fmt, crawl, deferred, hashes=('md5',),
+             blocksize=BLOCKSIZE, workers=0, hashsets=None, cachefile=None,
+             cachevolume=None, source=None):
+    '''
+        Second pass of a triage crawl: hashes the deferred (path, stat,
+        filetype) files in full and has the fmt backend upgrade
+        their rows in fname (and crawl, for SQLite) with the digests
+        and any hashsets match. Files changed since the triage pass
+        keep an empty digest. Returns the number of rows upgraded.
+    '''
+    hashing = functools.partial(_deferred_task, hashes=hashes,
+                                blocksize=blocksize)
+    if workers:
+        results = imap_bounded(hashing, deferred, workers, ordered=False)
+    else:
+        results = (hashing(task) for task in deferred)
+    cache = DigestCache(cachefile, volume=cachevolume,
+                        root=source) if cachefile else None
+
+    def upgraded():
+        for path, st, filetype, digests in results:
+            if not digests:
+                continue
+            values = dict((name, digests[name]) for name in hashes[1:])
+            values['digest'] = digests[hashes[0]]
+            if hashsets:
+                values['match'], values['hashset'] = matchhashsets(digests,
+                                                                   hashsets)
+            if cache:
+                cache.put(st, filetype, digests, path)
+            yield path, values
+
+    started = time.time()
+    try:
+        count = WRITERS[fmt].upgrade(fname, crawl, upgraded())
+    finally:
+        if cache:
+            cache.close()
+    logging.info("Full pass of %s upgraded %d of %d files in %.1f s" %
+                 (fname, count, len(deferred), time.time() - started))
+    return count
+
+
+def _lowpriority(func, *args, **kwargs):
+    # Linux derives the I/O priority of a process from its niceness
+    # unless one is set explicitly, so this yields the disk too
+    if hasattr(os, 'nice'):
+        os.nice(DEFERREDNICE)
+    return func(*args, **kwargs)
+
+
+def _spawnfullpass(fname, fmt, crawl, deferred, options):
+    '''
+        Runs fullpass in a fresh interpreter and returns its exit code.
+        A forked child of a crawl running next to others would inherit
+        locks (logging's among them) held by their threads, and could
+        wait on them forever. The job goes through a pickle of plain
+        values: stats as (dev, ino, size, mtime_ns), hash sets as
+        their list files.
+    '''
+    options = dict(options)
+    options['hashsets'] = [(hs.listfile, hs.status, hs.name)
+                           for hs in options['hashsets'] or ()]
+    logfile = None
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            logfile = handler.baseFilename
+    job = dict(fname=fname, fmt=fmt, crawl=crawl, options=options,
+               logfile=logfile,
+               deferred=[(path, (st.st_dev, st.st_ino, st.st_size,
+                                 _time_ns(st)), filetype)
+                         for path, st, filetype in deferred])
+    handle, jobfile = tempfile.mkstemp(suffix='.fullpass')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(job, f, 2)
+        return call([sys.executable, '-c',
+                     'import sys; sys.path.insert(0, sys.argv[1]); '
+                     'import crawler; crawler._fullpassjob(sys.argv[2])',
+                     os.path.dirname(os.path.abspath(__file__)), jobfile])
+    finally:
+        os.remove(jobfile)
+
+
+class _FileStat(object):
+    # what the full pass and the digest cache read of a stat
+    def __init__(self, dev, ino, size, mtime_ns):
+        self.st_dev, self.st_ino = dev, ino
+        self.st_size, self.st_mtime_ns = size, mtime_ns
+
+
+def _fullpassjob(jobfile):
+    with open(jobfile, 'rb') as f:
+        job = pickle.load(f)
+    if job['logfile']:
+        logging.basicConfig(filename=job['logfile'], level=logging.NOTSET,
+                            format='%(asctime)s %(message)s')
+    options = job['options']
+    options['hashsets'] = [HashSet(*each) for each in options['hashsets']]
+    deferred = [(path, _FileStat(*st), filetype)
+                for path, st, filetype in job['deferred']]
+    _lowpriority(fullpass, job['fname'], job['fmt'], job['crawl'], deferred,
+                 **options)
+
+
+def edgehash(path, size, edge=EDGESIZE):
+    '''
+        md5 of the first and last edge bytes of path: a cheap way to
+        split files of equal size before reading them in full.
+    '''
+    hasher = hashlib.md5()
+    with open(path, 'rb') as f:
+        hasher.update(f.read(edge))
+        f.seek(max(size - edge, edge))
+        hasher.update(f.read(edge))
+    return hasher.hexdigest()
+
+
+def _edge_task(task):
+    key, path, size, edge, hashname = task
+    try:
+        if size <= 2 * edge:
+            # the edges cover the whole file, so hash it for good
+            digest = checksum(path, [hashname], size=size)[hashname]
+            return key, size, 'full', digest
+        return key, size, 'edge', edgehash(path, size, edge)
+    except EnvironmentError as error:
+        logging.info('Error hashing %s: %s' % (path, error))
+        return key, size, None, None
+
+
+def _full_task(task):
+    key, path, size, hashname = task
+    try:
+        return key, size, checksum(path, [hashname], size=size)[hashname]
+    except EnvironmentError as error:
+        logging.info('Error hashing %s: %s' % (path, error))
+        return key, size, None
+
+
+def find_duplicates(sources, edge=EDGESIZE, hashname='md5', workers=0,
+                    processes=False, **kwargs):
+    '''
+        Finds files with identical content under sources. Files are
+        grouped by size first, so a file whose size is unique is never
+        read; equal sizes are split by edgehash and only what still
+        collides is hashed in full. Hard links to one inode are read
+        once. Returns a list of (size, digest, [paths]) groups, largest
+        first.
+    '''
+    def pmap(func, tasks):
+        if workers:
+            return imap_bounded(func, tasks, workers, processes=processes,
+                                ordered=False)
+        return (func(task) for task in tasks)
+
+    sizes = {}  # size -> [(dev, ino)]
+    paths = {}  # (dev, ino) -> {path}
+    for source in sources:
+        for path, st in gettasks(source, **kwargs):
+            if st is None or st.st_size == 0:
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key not in paths:
+                paths[key] = set()
+                sizes.setdefault(st.st_size, []).append(key)
+            # overlapping or repeated sources walk a path more than once
+            paths[key].add(path)
+
+    candidates = [(key, min(paths[key]), size, edge, hashname)
+                  for size, keys in sizes.items() for key in keys
+                  if len(keys) > 1 or len(paths[key]) > 1]
+    logging.info("Duplicates: %d files, %d sizes, %d to edge-hash" %
+                 (len(paths), len(sizes), len(candidates)))
+    groups, edges = {}, {}
+    for key, size, kind, digest in pmap(_edge_task, candidates):
+        if kind == 'full':
+            groups.setdefault((size, digest), []).append(key)
+        elif kind == 'edge':
+            edges.setdefault((size, digest), []).append(key)
+
+    fullhash = [(key, min(paths[key]), size, hashname)
+                for (size, _), keys in edges.items() for key in keys
+                if len(keys) > 1 or len(paths[key]) > 1]
+    logging.info("Duplicates: %d to hash in full" % len(fullhash))
+    for key, size, digest in pmap(_full_task, fullhash):
+        if digest:
+            groups.setdefault((size, digest), []).append(key)
+
+    duplicates = []
+    for (size, digest), keys in groups.items():
+        found = sorted(path for key in keys for path in paths[key])
+        if len(found) > 1:
+            duplicates.append((size, digest, found))
+    duplicates.sort(key=lambda group: (-group[0], group[1]))
+    return duplicates
+
+
+def write_duplicates(fname, duplicates):
+    '''
+        Writes duplicate groups as CSV, one row per file.
+    '''
+    with open(fname, 'w') as report:
+        writer = csv.writer(report)
+        writer.writerow(['group', 'filesize', 'digest', 'path'])
+        for num, (size, digest, found) in enumerate(duplicates, 1):
+            for path in found:
+                writer.writerow([num, size, digest, path])
+
+
+def crawlpair(rollups, crawls):
+    '''
+        The (old, new) crawl ids to diff: crawls is either two ids or a
+        source, whose last two finished crawls are taken.
+    '''
+    if len(crawls) == 2 and all(c.isdigit() for c in crawls):
+        return int(crawls[0]), int(crawls[1])
+    if len(crawls) == 1:
+        found = rollups.crawls(crawls[0])
+        if len(found) >= 2:
+            return found[-2][0], found[-1][0]
+    raise ValueError("--diff takes two crawl ids, or a path crawled at "
+                     "least twice with --rollups")
+
+
+def write_diff(fname, source, changes, timeformat=None):
+    '''
+        Writes the changes from RollupStore.diff as CSV, one row per
+        file, with the size, mtime and digest on either side.
+    '''
+    timeformat = timeformat or TimeFormatter()
+    counts = dict.fromkeys(['added', 'removed', 'modified'], 0)
+    with open(fname, 'w') as report:
+        writer = csv.writer(report)
+        writer.writerow(['change', 'path', 'old_filesize', 'old_mtime',
+                         'old_digest', 'filesize', 'mtime', 'digest'])
+        for change, rel, old, new in changes:
+            counts[change] += 1
+            row = [change, os.path.join(source, rel)]
+            for side in (old, new):
+                size, mtime, digest = side or (None, None, None)
+                row += [size, timeformat.format(mtime)
+                        if mtime is not None else None, digest]
+            writer.writerow(row)
+    return counts
+
+
+def _terminate(signum, frame):
+    # turn SIGTERM into SystemExit so buffered output gets flushed
+    sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -217,32 +3454,269 @@ if __name__ == "__main__":
                         format='%(asctime)s %(message)s')
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--path", help="Direct file path to be crawled",
-                        type=str)
+    parser.add_argument("--path", help="Direct file path to be crawled; \
+                        several paths are crawled at once, one I/O lane \
+                        per physical disk", type=str, nargs="+")
     parser.add_argument("--usb", help="In USB mode, script monitors for events \
                         and crawls them continuously", default=False)
+    parser.add_argument("--duplicates", help="Report files with identical \
+                        content across these directories instead of \
+                        crawling", nargs="+", metavar="PATH")
+    parser.add_argument("--edge-size", help="Bytes hashed from each end of \
+                        equal-sized files before full hashing in \
+                        --duplicates mode", type=int, default=EDGESIZE)
+    parser.add_argument("--registry", help="Database of devices crawled in \
+                        USB mode, also used as the digest cache unless \
+                        --cache is given", type=str,
+                        default="filer-devices.db")
+    parser.add_argument("--full-every", help="In USB mode, re-crawl a known \
+                        device in full if its last full crawl is older \
+                        than this many days", type=float)
+    parser.add_argument("--maxdepth", help="Do not descend more than this \
+                        many directories below the crawled path", type=int)
+    parser.add_argument("--prune", help="Skip files and directories whose \
+                        name matches this glob; may be repeated",
+                        action="append", default=[])
+    parser.add_argument("--follow-symlinks", help="Descend into symbolic \
+                        links to directories while crawling; links to \
+                        files are always crawled", action="store_true")
+    parser.add_argument("--workers", help="Hash and detect file types on \
+                        this many parallel workers", type=int, default=0)
+    parser.add_argument("--processes", help="Use a process pool instead of \
+                        threads for --workers", action="store_true")
+    parser.add_argument("--unordered", help="Write rows in completion order \
+                        rather than walk order", action="store_true")
+    parser.add_argument("--queue-size", help="Maximum files in flight \
+                        between the walker and the writer", type=int)
+    parser.add_argument("--walkers", help="List directories and stat files \
+                        on this many threads; for network and FUSE mounts \
+                        where each call waits on a round trip", type=int,
+                        default=0)
+    parser.add_argument("--per-mount", help="Most listing, stat and read \
+                        calls in flight at once on any one device",
+                        type=int)
+    parser.add_argument("--lane-depth-rotational", help="Reads in flight \
+                        at once on a spinning disk when crawling several \
+                        devices", type=int, default=1)
+    parser.add_argument("--lane-depth-solid", help="Reads in flight at \
+                        once on flash and other devices when crawling \
+                        several devices", type=int, default=4)
+    parser.add_argument("--read-order", help="Read files in inode order, \
+                        or by physical extent offset where FIEMAP is \
+                        available, instead of walk order; cuts seeking on \
+                        spinning disks", choices=["inode", "extent"])
+    parser.add_argument("--read-window", help="Files gathered and sorted \
+                        at a time for --read-order", type=int, default=10000)
+    parser.add_argument("--triage", help="Record stat, type and a sampled \
+                        fingerprint of every file first, then hash large \
+                        files in full in a lower-priority pass that fills \
+                        in their digests", action="store_true")
+    parser.add_argument("--rollups", help="Database of per-directory \
+                        rollup hashes, recorded for every crawl and used \
+                        by --skip-unchanged and --diff", type=str)
+    parser.add_argument("--skip-unchanged", help="Carry directories whose \
+                        mtime and ctime match the last crawl in --rollups \
+                        over without listing them or reading their files",
+                        action="store_true")
+    parser.add_argument("--diff", help="Report files added, removed or \
+                        modified between two crawls in --rollups, given as \
+                        two crawl ids or a path to compare its last two \
+                        crawls", nargs="+", metavar="CRAWL")
+    parser.add_argument("--cache", help="Persistent digest cache; unchanged \
+                        files are not re-hashed on later crawls", type=str)
+    parser.add_argument("--full", help="Ignore cached digests and hash every \
+                        file again, refreshing the cache", action="store_true")
+    parser.add_argument("--cache-max-age", help="Drop cache entries not seen \
+                        in this many days", type=float)
+    parser.add_argument("--db", help="Append results to this SQLite database \
+                        instead of writing a CSV file per crawl", type=str)
+    parser.add_argument("--format", help="Output format of the file written \
+                        per crawl; columnar is compact and fast to load \
+                        (see columnar.py)", choices=sorted(SUFFIXES),
+                        default="csv")
+    parser.add_argument("--time-format", help="How CSV output shows \
+                        timestamps; other formats keep nanoseconds",
+                        choices=TimeFormatter.STYLES, default="iso")
+    parser.add_argument("--timezone", help="local, utc or a fixed offset \
+                        like +05:30 for --time-format iso and asctime",
+                        default="local")
+    parser.add_argument("--hash", help="Digest algorithm to compute, may be \
+                        repeated; the first fills the digest column",
+                        action="append", choices=HASHES, dest="hashes")
+    parser.add_argument("--chunk-size", help="Read size used for hashing, in \
+                        bytes", type=int, default=BLOCKSIZE)
+    parser.add_argument("--sniff-size", help="Bytes from the start of each \
+                        file used for type detection", type=int,
+                        default=SNIFFSIZE)
+    parser.add_argument("--trust-ext", help="Take the file type from this \
+                        extension (e.g. .jpg) without running libmagic; may \
+                        be repeated", action="append", default=[])
+    parser.add_argument("--known-good", help="Hash list (NSRL or one hash \
+                        per line) of known-good files; may be repeated",
+                        action="append", default=[])
+    parser.add_argument("--known-bad", help="Hash list of known-bad files; \
+                        may be repeated", action="append", default=[])
+    parser.add_argument("--checkpoint", help="Save crawl progress to this \
+                        state file so an interrupted crawl can be resumed",
+                        type=str)
+    parser.add_argument("--checkpoint-interval", help="Seconds between \
+                        checkpoints", type=float, default=60.0)
+    parser.add_argument("--resume", help="Continue the crawl saved in \
+                        --checkpoint instead of starting over",
+                        action="store_true")
+    parser.add_argument("--index", help="Add finished crawls to this search \
+                        index (see search.py)", type=str)
+    parser.add_argument("--progress", help="Show a live line with files/s, \
+                        MB/s, errors and time per file in each stage",
+                        action="store_true")
+    parser.add_argument("--stats", help="Write crawl statistics (per-stage \
+                        timing histograms, bytes, errors by type) to this \
+                        JSON file while crawling", type=str)
+    parser.add_argument("--stats-interval", help="Seconds between --stats \
+                        updates", type=float, default=10.0)
+    parser.add_argument("--profile", help="Save a cProfile profile of a \
+                        sample of files to this file (python -m pstats)",
+                        type=str)
+    parser.add_argument("--profile-every", help="With --profile, profile \
+                        one file in this many", type=int, default=100)
+    parser.add_argument("--flush-rows", help="Flush output after this many \
+                        rows", type=int)
+    parser.add_argument("--flush-bytes", help="Flush output once about this \
+                        many bytes are buffered", type=int)
+    parser.add_argument("--flush-interval", help="Flush output at least this \
+                        often, in seconds", type=float)
+    parser.add_argument("--writer-thread", help="Write output on a \
+                        background thread", action="store_true")
     args = parser.parse_args()
+    HASHSETS = [HashSet(listfile, 'good') for listfile in args.known_good]
+    HASHSETS += [HashSet(listfile, 'bad') for listfile in args.known_bad]
+    HASHLIST = []
+    # also compute whatever the hash sets need to be matched against
+    for name in (args.hashes or ['md5']) + [hs.algorithm for hs in HASHSETS]:
+        if name not in HASHLIST:
+            HASHLIST.append(name)
+    for name in HASHLIST:
+        if name not in hashlib.algorithms_available:
+            parser.error("%s is not supported by this Python" % name)
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs --checkpoint")
+    if args.checkpoint and args.path and len(args.path) > 1:
+        parser.error("--checkpoint works with a single --path")
+    if args.checkpoint and args.triage:
+        parser.error("--triage cannot be used with --checkpoint")
+    if args.checkpoint and args.rollups:
+        parser.error("--rollups cannot be used with --checkpoint")
+    if (args.skip_unchanged or args.diff) and not args.rollups:
+        parser.error("--skip-unchanged and --diff need --rollups")
+    signal.signal(signal.SIGTERM, _terminate)
     PATH, USB = args.path, args.usb
+    CACHEMAXAGE = args.cache_max_age
+    if CACHEMAXAGE is not None:
+        CACHEMAXAGE *= 86400
     STARTINGTIME = time.time()
 
-    temp_filename = "".join([x if x.isalnum() else "_" for x in PATH])
-    FILENAME = temp_filename + time.ctime(time.time()) + ".csv"
-    if PATH is not None:
-        write_data(FILENAME, PATH)
+    DBFILE = args.db
+    INDEXFILE = args.index
+    LANES = IOLanes(args.lane_depth_rotational, args.lane_depth_solid)
+    # unset flush limits are left to each writer's own defaults
+    WRITEROPTS = dict((key, value) for key, value in
+                      [('flushrows', args.flush_rows),
+                       ('flushbytes', args.flush_bytes),
+                       ('flushinterval', args.flush_interval)]
+                      if value is not None)
+    try:
+        WRITEROPTS['timeformat'] = TimeFormatter(args.time_format,
+                                                 args.timezone)
+    except ValueError as error:
+        parser.error(str(error))
+    CRAWLOPTS.update(fmt='sqlite' if DBFILE else args.format,
+                     maxdepth=args.maxdepth, prune=args.prune,
+                     followlinks=args.follow_symlinks, workers=args.workers,
+                     processes=args.processes, ordered=not args.unordered,
+                     queuesize=args.queue_size, cachefile=args.cache,
+                     full=args.full, cachemaxage=CACHEMAXAGE,
+                     writeropts=WRITEROPTS,
+                     background=args.writer_thread, hashes=HASHLIST,
+                     blocksize=args.chunk_size, sniffsize=args.sniff_size,
+                     trustext=tuple(ext.lower() if ext.startswith('.')
+                                    else '.' + ext.lower()
+                                    for ext in args.trust_ext),
+                     hashsets=HASHSETS, progress=args.progress,
+                     statsfile=args.stats, statsinterval=args.stats_interval,
+                     profileevery=args.profile_every if args.profile else 0,
+                     profilefile=args.profile, walkers=args.walkers,
+                     permount=args.per_mount, order=args.read_order,
+                     orderwindow=args.read_window, triage=args.triage,
+                     rollupfile=args.rollups,
+                     skipunchanged=args.skip_unchanged)
+
+    if args.diff:
+        ROLLUPS = RollupStore(args.rollups)
+        try:
+            OLD, NEW = crawlpair(ROLLUPS, args.diff)
+        except ValueError as error:
+            parser.error(str(error))
+        SOURCE = dict((crawl, source) for crawl, source, _, _
+                      in ROLLUPS.crawls()).get(NEW, '')
+        FILENAME = "diff %d-%d %s.csv" % (OLD, NEW, time.ctime(time.time()))
+        COUNTS = write_diff(FILENAME, SOURCE, ROLLUPS.diff(OLD, NEW),
+                            WRITEROPTS['timeformat'])
+        ROLLUPS.close()
+        print "Crawl %d to %d: %d added, %d removed, %d modified. " \
+            "Saved to: %s" % (OLD, NEW, COUNTS['added'], COUNTS['removed'],
+                              COUNTS['modified'], FILENAME)
+
+    elif args.duplicates:
+        FILENAME = "duplicates " + time.ctime(time.time()) + ".csv"
+        print "Finding duplicates in %s. Saving them to: %s" % (
+            ", ".join(args.duplicates), FILENAME)
+        write_duplicates(FILENAME, find_duplicates(
+            args.duplicates, edge=args.edge_size, hashname=HASHLIST[0],
+            workers=args.workers, processes=args.processes,
+            maxdepth=args.maxdepth, prune=args.prune,
+            followlinks=args.follow_symlinks))
+
+    elif PATH is not None:
+        JOBS = []
+        for source in PATH:
+            temp_filename = "".join([x if x.isalnum() else "_"
+                                     for x in source])
+            JOBS.append((DBFILE or (temp_filename + time.ctime(time.time()) +
+                                    SUFFIXES[CRAWLOPTS['fmt']]), source))
+        if len(JOBS) == 1:
+            write_data(JOBS[0][0], PATH[0], checkpoint=args.checkpoint,
+                       resume=args.resume,
+                       checkpointinterval=args.checkpoint_interval,
+                       **CRAWLOPTS)
+        else:
+            fanout(JOBS, lanes=LANES, **CRAWLOPTS)
+        if INDEXFILE:
+            search.update(INDEXFILE, sorted(set(fname for fname, _ in JOBS)))
 
-    # Warning: This loop is buggy
     elif USB is not False:
         print "USB mode, baby!"
         context = usb1.USBContext()
         if not context.hasCapability(libusb1.LIBUSB_CAP_HAS_HOTPLUG):
             print 'Hotplug support is missing. Please update libusb version.'
             sys.exit(1)
+        REGISTRY = DeviceRegistry(args.registry, args.full_every and
+                                  args.full_every * 86400)
+        # unchanged files on a known device are not hashed again
+        CRAWLOPTS['cachefile'] = args.cache or args.registry
+        # devices crawled at the same time share one hashing pool, with
+        # a read lane per disk
+        CRAWLOPTS.update(pool=ThreadPool(args.workers or
+                                         multiprocessing.cpu_count()),
+                         lanes=LANES, processes=False)
+        SCHEDULER = CrawlScheduler()
+        SCHEDULER.start()
         opaque = context.hotplugRegisterCallback(hotplug_callback)
         try:
             while True:
                 context.handleEvents()
         except (KeyboardInterrupt, SystemExit):
             print "Exiting.."
+            SCHEDULER.stop()
             sys.exit(1)
 
     TOTALTIME = time.time() - STARTINGTIME
@@ -0,0 +1,300 @@
+'''
+    Indexes crawl output and searches it.
+    Usage:
+        python search.py --add <crawl.csv, .fcol or .db> [--add ...]
+        python search.py holiday jpg --type image/% --min-size 100000
+        python search.py --digest d41d8cd98f00b204e9800998ecf8427e
+
+    Results from every crawl added are kept in one SQLite index
+    (filer-index.db by default). Path components are searchable through
+    an FTS5 table and filetype, size, mtime and digest through ordinary
+    indexes. Adding the same output again only picks up what is new.
+'''
+import os
+import sys
+import csv
+import re
+import time
+import calendar
+import logging
+import sqlite3
+import argparse
+
+import columnar
+
+INDEX = 'filer-index.db'
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS sources (
+        id INTEGER PRIMARY KEY, location TEXT, crawl INTEGER,
+        label TEXT, signature TEXT, added REAL);
+    CREATE UNIQUE INDEX IF NOT EXISTS sources_location
+        ON sources(location, crawl);
+    CREATE TABLE IF NOT EXISTS files (
+        id INTEGER PRIMARY KEY, source INTEGER REFERENCES sources(id),
+        path TEXT, filetype TEXT, filesize INTEGER, mtime REAL, digest TEXT);
+    CREATE INDEX IF NOT EXISTS files_filetype ON files(filetype);
+    CREATE INDEX IF NOT EXISTS files_filesize ON files(filesize);
+    CREATE INDEX IF NOT EXISTS files_mtime ON files(mtime);
+    CREATE INDEX IF NOT EXISTS files_digest ON files(digest);
+    CREATE VIRTUAL TABLE IF NOT EXISTS paths USING fts5(
+        path, content='files', content_rowid='id');
+'''
+COLUMNS = ['path', 'filetype', 'filesize', 'mtime', 'digest']
+
+
+def opendb(indexfile=INDEX):
+    conn = sqlite3.connect(indexfile, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+ISOTIME = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?'
+                     r'(Z|[+-]\d\d:?\d\d)?$')
+
+
+def totime(value):
+    '''
+        Epoch seconds from a crawl timestamp: nanoseconds (what crawls
+        store now), seconds, an ISO 8601 string or the time.asctime
+        string older crawls wrote.
+    '''
+    if value in (None, ''):
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        match = ISOTIME.match(value)
+        if not match:
+            return time.mktime(time.strptime(value))
+        stamp, fraction, zone = match.groups()
+        tm = time.strptime(stamp, '%Y-%m-%dT%H:%M:%S')
+        fraction = float(fraction or 0)
+        if not zone:
+            return time.mktime(tm) + fraction
+        offset = 0
+        if zone != 'Z':
+            sign = -1 if zone[0] == '-' else 1
+            zone = zone[1:].replace(':', '')
+            offset = sign * (int(zone[:2]) * 3600 + int(zone[2:]) * 60)
+        return calendar.timegm(tm) - offset + fraction
+    # nothing in seconds is this big before the year 5000
+    return number / 1e9 if abs(number) > 1e11 else number
+
+
+def _row(record):
+    size = record.get('filesize')
+    return (record.get('path'), record.get('filetype'),
+            int(size) if size not in (None, '') else None,
+            totime(record.get('mtime')), record.get('digest'))
+
+
+# Python 2 csv yields byte strings, and crawler --db keeps paths that
+# are not UTF-8 as BLOBs; sqlite3 and the FTS index want text
+_BINARY = (bytes,) if sys.version_info[0] >= 3 else (str, buffer)
+
+
+def _text(value):
+    if isinstance(value, _BINARY):
+        return bytes(value).decode('utf-8', 'replace')
+    return value
+
+
+def _insert(conn, sourceid, rows):
+    count = 0
+    for row in rows:
+        row = tuple(_text(value) for value in row)
+        cur = conn.execute('INSERT INTO files (source, path, filetype, '
+                           'filesize, mtime, digest) VALUES (?,?,?,?,?,?)',
+                           (sourceid,) + row)
+        conn.execute('INSERT INTO paths (rowid, path) VALUES (?, ?)',
+                     (cur.lastrowid, row[0]))
+        count += 1
+    return count
+
+
+def _forget(conn, sourceid):
+    # drop a source's rows from both the table and the FTS index
+    conn.execute("INSERT INTO paths (paths, rowid, path) "
+                 "SELECT 'delete', id, path FROM files WHERE source = ?",
+                 (sourceid,))
+    conn.execute('DELETE FROM files WHERE source = ?', (sourceid,))
+    conn.execute('DELETE FROM sources WHERE id = ?', (sourceid,))
+
+
+def add_file(conn, fname, records):
+    '''
+        Adds the records of a crawl output file, unless this exact file
+        was added before; a file that changed since (e.g. a resumed
+        crawl) replaces its rows. records is called to read the file.
+    '''
+    location = os.path.abspath(fname)
+    st = os.stat(fname)
+    signature = '%d-%d' % (st.st_size, int(st.st_mtime))
+    old = conn.execute('SELECT id, signature FROM sources '
+                       'WHERE location = ? AND crawl IS NULL',
+                       (location,)).fetchone()
+    if old and old[1] == signature:
+        return 0
+    with conn:
+        if old:
+            _forget(conn, old[0])
+        sourceid = conn.execute(
+            'INSERT INTO sources (location, label, signature, added) '
+            'VALUES (?, ?, ?, ?)', (location, os.path.basename(fname),
+                                    signature, time.time())).lastrowid
+        return _insert(conn, sourceid, (_row(rec) for rec in records()))
+
+
+def add_csv(conn, csvfile):
+    def records():
+        with open(csvfile) as f:
+            for record in csv.DictReader(f):
+                yield record
+    return add_file(conn, csvfile, records)
+
+
+def add_columnar(conn, fname):
+    def records():
+        crawl = columnar.ColumnarFile(fname)
+        for record in crawl.records([key for key in COLUMNS
+                                     if key in crawl.fields]):
+            if record.get('mtime') == columnar.INTNULL:
+                record['mtime'] = None
+            yield record
+        crawl.close()
+    return add_file(conn, fname, records)
+
+
+def add_db(conn, dbfile):
+    '''
+        Adds every finished crawl in a crawler --db database that is
+        not in the index yet.
+    '''
+    location = os.path.abspath(dbfile)
+    crawldb = sqlite3.connect(dbfile, timeout=60)
+    have = set(crawl for (crawl,) in conn.execute(
+        'SELECT crawl FROM sources WHERE location = ?', (location,)))
+    count = 0
+    crawls = crawldb.execute('SELECT id, source FROM crawls '
+                             'WHERE finished IS NOT NULL ORDER BY id')
+    for crawl, label in crawls.fetchall():
+        if crawl in have:
+            continue
+        with conn:
+            sourceid = conn.execute(
+                'INSERT INTO sources (location, crawl, label, added) '
+                'VALUES (?, ?, ?, ?)',
+                (location, crawl, label, time.time())).lastrowid
+            rows = crawldb.execute('SELECT %s FROM files WHERE crawl = ?' %
+                                   ', '.join(COLUMNS), (crawl,))
+            count += _insert(conn, sourceid,
+                             (_row(dict(zip(COLUMNS, rec))) for rec in rows))
+    crawldb.close()
+    return count
+
+
+def update(indexfile, outputs):
+    '''
+        Brings the index up to date with crawl outputs: CSV files,
+        columnar files or SQLite databases. Returns the number of rows
+        added.
+    '''
+    conn = opendb(indexfile)
+    count = 0
+    for output in outputs:
+        if output.endswith('.csv'):
+            count += add_csv(conn, output)
+        elif output.endswith('.fcol'):
+            count += add_columnar(conn, output)
+        else:
+            count += add_db(conn, output)
+    conn.close()
+    logging.info("Indexed %d new rows into %s" % (count, indexfile))
+    return count
+
+
+def parsedate(value):
+    '''
+        Epoch seconds from YYYY-MM-DD[THH:MM[:SS]] or a plain number.
+    '''
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("bad date: %s" % value)
+
+
+def search(conn, terms=(), filetype=None, minsize=None, maxsize=None,
+           after=None, before=None, digest=None, limit=100):
+    '''
+        Files whose path contains every term (as a prefix of a path
+        component) and that pass all the given filters. filetype may
+        use SQL LIKE wildcards, e.g. image/%.
+    '''
+    where, params = [], []
+    if terms:
+        query = ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+        where.append('files.id IN (SELECT rowid FROM paths '
+                     'WHERE paths MATCH ?)')
+        params.append(query)
+    for clause, value in [('filetype LIKE ?', filetype),
+                          ('filesize >= ?', minsize),
+                          ('filesize <= ?', maxsize),
+                          ('mtime >= ?', after),
+                          ('mtime < ?', before),
+                          ('digest = ?', digest and digest.lower())]:
+        if value is not None:
+            where.append(clause)
+            params.append(value)
+    sql = ('SELECT files.path, filetype, filesize, mtime, digest, label '
+           'FROM files JOIN sources ON sources.id = files.source')
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY mtime DESC LIMIT ?'
+    return conn.execute(sql, params + [limit]).fetchall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("terms", nargs="*",
+                        help="Words that must appear in the path")
+    parser.add_argument("--index", help="Search index file", default=INDEX)
+    parser.add_argument("--add", help="Index this crawl output (CSV, \
+                        columnar or --db database) first; may be repeated",
+                        action="append", default=[])
+    parser.add_argument("--type", help="MIME type, %% as wildcard",
+                        dest="filetype")
+    parser.add_argument("--min-size", type=int)
+    parser.add_argument("--max-size", type=int)
+    parser.add_argument("--after", type=parsedate,
+                        help="Modified on or after YYYY-MM-DD")
+    parser.add_argument("--before", type=parsedate,
+                        help="Modified before YYYY-MM-DD")
+    parser.add_argument("--digest", help="Exact digest")
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.add:
+        print "Indexed %d new files" % update(args.index, args.add)
+    filters = [args.filetype, args.min_size, args.max_size, args.after,
+               args.before, args.digest]
+    if args.terms or filters != [None] * len(filters) or not args.add:
+        STARTINGTIME = time.time()
+        conn = opendb(args.index)
+        found = search(conn, args.terms, args.filetype, args.min_size,
+                       args.max_size, args.after, args.before, args.digest,
+                       args.limit)
+        for path, filetype, size, mtime, digest, label in found:
+            when = time.strftime('%Y-%m-%d %H:%M',
+                                 time.localtime(mtime)) if mtime else ''
+            # encoded here, or a pipe takes it as ASCII
+            print u"\t".join([when, str(size), filetype or '', label or '',
+                              path]).encode('utf-8')
+        print "%d files in %.1f ms" % (len(found),
+                                        (time.time() - STARTINGTIME) * 1000)
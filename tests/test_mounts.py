@@ -0,0 +1,122 @@
+'''
+    Removable-mount discovery against the fixture mountinfo files and
+    sysfs/udev trees in fixtures/mounts: a Kingston stick (sdb) and a
+    card reader (sdc) on USB, and an internal SATA disk (sda).
+    Run with python -m unittest discover tests.
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import crawler
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures', 'mounts')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+
+class ParseMountinfoTest(unittest.TestCase):
+
+    def test_fields(self):
+        mounts = crawler.parse_mountinfo(fixture('mountinfo.stick'))
+        self.assertEqual(len(mounts), 5)
+        self.assertEqual(mounts[0], {'devno': '8:1', 'root': '/',
+                                     'mount_point': '/', 'fstype': 'ext4',
+                                     'source': '/dev/sda1'})
+        self.assertEqual(mounts[-1]['fstype'], 'vfat')
+
+    def test_octal_escapes(self):
+        mounts = crawler.parse_mountinfo(fixture('mountinfo.bind'))
+        self.assertEqual(mounts[-2]['mount_point'], '/media/user/MY STICK')
+        self.assertEqual(mounts[-1]['mount_point'], '/mnt/back\\slash')
+        self.assertEqual(mounts[-1]['root'], '/photos')
+
+    def test_skips_malformed_lines(self):
+        self.assertEqual(crawler.parse_mountinfo('garbage\n\n'), [])
+
+
+class MountWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        # a copy, so mountinfo and sysfs links can change under the
+        # watcher like the real ones do
+        self.root = tempfile.mkdtemp()
+        for name in ('sys', 'dev'):
+            shutil.copytree(os.path.join(FIXTURES, name),
+                            os.path.join(self.root, name), symlinks=True)
+        self.mountinfo = os.path.join(self.root, 'mountinfo')
+        self.mount('mountinfo.boot')
+        self.watcher = crawler.MountWatcher(
+            self.mountinfo, os.path.join(self.root, 'sys'),
+            os.path.join(self.root, 'dev'))
+
+    def tearDown(self):
+        self.watcher.handle.close()
+        shutil.rmtree(self.root)
+
+    def mount(self, name):
+        # rewritten in place: the watcher keeps its handle open
+        with open(self.mountinfo, 'w') as f:
+            f.write(fixture(name))
+
+    def test_internal_disk_is_ignored(self):
+        self.assertEqual(self.watcher.changes(), [])
+
+    def test_partition_resolves_to_usb_disk(self):
+        self.mount('mountinfo.stick')
+        devices = self.watcher.changes()
+        self.assertEqual(devices, [{
+            'mount_point': ['/media/user/MY STICK'],
+            'volume_name': ['MY STICK'],
+            'volume_uuid': ['1234-ABCD'],
+            '_name': 'DataTraveler 3.0', 'manufacturer': 'Kingston',
+            'vendor_id': '0951', 'product_id': '1666'}])
+
+    def test_only_new_mounts_are_reported(self):
+        self.mount('mountinfo.stick')
+        self.assertEqual(len(self.watcher.changes()), 1)
+        self.assertEqual(self.watcher.changes(), [])
+        self.mount('mountinfo.bind')
+        devices = self.watcher.changes()
+        self.assertEqual(len(devices), 1)
+        self.assertEqual(devices[0]['mount_point'], ['/mnt/back\\slash'])
+
+    def test_label_falls_back_on_mount_point(self):
+        os.remove(os.path.join(self.root, 'dev', 'disk', 'by-label',
+                               'MY\\x20STICK'))
+        self.mount('mountinfo.bind')
+        devices = self.watcher.changes()
+        self.assertEqual(devices[0]['volume_name'],
+                         ['MY STICK', 'back\\slash'])
+
+    def test_reused_devno_after_unmount(self):
+        self.mount('mountinfo.stick')
+        self.assertEqual(self.watcher.changes()[0]['_name'],
+                         'DataTraveler 3.0')
+        self.mount('mountinfo.boot')
+        self.assertEqual(self.watcher.changes(), [])
+        # the kernel hands 8:17 to the next device plugged in
+        link = os.path.join(self.root, 'sys', 'dev', 'block', '8:17')
+        target = os.readlink(link).replace(
+            '2-1/2-1:1.0/host6/target6:0:0/6:0:0:0/block/sdb/sdb1',
+            '2-2/2-2:1.0/host7/target7:0:0/7:0:0:0/block/sdc/sdc1')
+        os.remove(link)
+        os.symlink(target, link)
+        self.mount('mountinfo.reader')
+        devices = self.watcher.changes()
+        self.assertEqual(len(devices), 1)
+        self.assertEqual(devices[0]['_name'], 'Card Reader')
+        self.assertEqual(devices[0]['vendor_id'], '05e3')
+        self.assertEqual(devices[0]['volume_uuid'], ['5678-EF01'])
+
+
+if __name__ == '__main__':
+    unittest.main()